@@ -4,17 +4,64 @@ import json
 import uuid
 import yaml
 import logging
+import threading
 from flask import Flask, request
-from const import r, WEBHOOK_TOKEN, admin_chat_id, bot_token
+from const import r, WEBHOOK_TOKEN, METRICS_TOKEN, admin_chat_id, bot_token
 from functools import wraps
-from common.send_message import _send_message
+from common.send_message import deliver_message
 from common.get_chat_info import get_chat_info
+from common.config import YAML_LOADER, save_config
+from common import metrics, outbox
 
 app = Flask(__name__)
 gunicorn_logger = logging.getLogger('gunicorn.error')
 app.logger.handlers = gunicorn_logger.handlers
 app.logger.setLevel(gunicorn_logger.level)
 
+# Notifications to the admin are queued in the outbox, and sent by a thread of each web process, so that the webhook returns at once.
+notify = threading.Event()
+notifier = None
+# Rendered responses, with the version of the data they are rendered from.
+cache = {}
+
+
+def notify_admin(pipe, text):
+    # Queues the notification in the transaction of `pipe`. Call `start_notifier` once it is executed.
+    if admin_chat_id:
+        outbox.enqueue(pipe, admin_chat_id, [{"type": "Message", "args": {"text": text}}])
+
+
+def send_notifications():
+    while True:
+        notify.wait()
+        notify.clear()
+        try:
+            outbox.drain_chat(admin_chat_id, lambda chat_id, message: deliver_message(bot_token, chat_id, message))
+        except Exception as e:
+            # Keep the thread for the next notifications. What is left queued is sent with them.
+            app.logger.exception("Failed to send the notifications. Error `%s`.", e)
+
+
+def start_notifier():
+    global notifier
+    # Nothing is queued without an admin chat.
+    if not admin_chat_id:
+        return
+    # Started in the web process itself, rather than in the gunicorn master it may be forked from.
+    if notifier is None:
+        notifier = threading.Thread(target=send_notifications, daemon=True)
+        notifier.start()
+    notify.set()
+
+
+def cached(key, version, render):
+    # Renders again only when the version changes.
+    if version is None:
+        return render()
+    if (entry := cache.get(key)) is None or entry[0] != version:
+        entry = cache[key] = (version, render())
+    return entry[1]
+
 
 def pre(func):
     @wraps(func)
@@ -65,12 +112,19 @@ def update_hook():
                     "id", "type", "title", "username", "first_name", "last_name"
                 ]
             }
-            r.hset("chats", chat_id, json.dumps(chat_info))
-            _send_message(bot_token, admin_chat_id, text=f"New chat: {chat_info}")
+            with r.pipeline() as pipe:
+                pipe.hset("chats", chat_id, json.dumps(chat_info))
+                pipe.incr("chats_version")
+                notify_admin(pipe, f"New chat: {chat_info}")
+                pipe.execute()
         else:
             chat_info = get_chat_info(chat_id)
-            r.hdel("chats", chat_id)
-            _send_message(bot_token, admin_chat_id, text=f"The bot was removed or restricted from chat: {chat_info}")
+            with r.pipeline() as pipe:
+                pipe.hdel("chats", chat_id)
+                pipe.incr("chats_version")
+                notify_admin(pipe, f"The bot was removed or restricted from chat: {chat_info}")
+                pipe.execute()
+        start_notifier()
     return "ok"
 
 
@@ -79,10 +133,10 @@ def update_hook():
 @pre
 @verificate()
 def get_chats():
-    return yaml.dump([
+    return cached("chats", r.get("chats_version") or "0", lambda: yaml.dump([
         json.loads(v)
         for k, v in r.hgetall("chats").items()
-    ], allow_unicode=True)
+    ], allow_unicode=True))
 
 
 @app.route("/getConfig", methods=["GET"])
@@ -90,19 +144,24 @@ def get_chats():
 @pre
 @verificate()
 def get_config():
-    return yaml.dump(yaml.load(r.get("config"), yaml.Loader), allow_unicode=True)
+    return cached("config", r.get("config_version"), lambda: yaml.dump(yaml.load(r.get("config"), YAML_LOADER), allow_unicode=True))
 
 
 @app.route("/setConfig", methods=["GET"])
 @app.route("/setConfig/<string:token>", methods=["POST"])
 @verificate()
 def set_config():
-    data = request.files["config.yml"].stream.read()
+    data = request.files["config.yml"].stream.read().decode("utf-8")
     try:
-        yaml.load(data, yaml.Loader)
-    except yaml.parser.ParserError as e:
+        # Resolve the config once here, so that the fetch job does not have to.
+        save_config(r, data)
+    except (yaml.YAMLError, ValueError) as e:
         return "Cannot parse the posted data.\n{}".format(e)
-    if r.set("config", data):
-        return "ok"
-    else:
-        return "error"
+    return "ok"
+
+
+if METRICS_TOKEN:
+    @app.route(f"/metrics/{METRICS_TOKEN}", methods=["GET"])
+    def get_metrics():
+        # The stats of the last run of `scripts/fetch.py`, for Prometheus.
+        return metrics.to_prometheus(metrics.get_summaries(1)), 200, {"Content-Type": "text/plain; version=0.0.4"}
@@ -0,0 +1,122 @@
+# coding: utf-8
+
+import hashlib
+import io
+import json
+import os
+import pickle
+import threading
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# A run of `scripts/fetch.py --record DIR` saves into `DIR`, to be run again offline by `scripts/replay.py DIR`:
+#   state.pickle: the config of the run, and what it read from Redis (see `common.store`).
+#   responses.json: `{key: {"method", "url", "status", "headers"}}` of the responses to the requests for the feeds.
+#   bodies/<key>: the body of each response, decompressed, as far as the run read it (e.g. not beyond `max_bytes`).
+#     A replay reading further (e.g. with another config) finds the body cut there.
+# The key of a response is a hash of the method, the URL and the body of its request.
+
+# Not true of the bodies once decompressed.
+DROPPED_HEADERS = ["content-encoding", "content-length", "transfer-encoding"]
+
+
+def get_key(request):
+    body = request.body or b""
+    body = body.encode("utf-8") if isinstance(body, str) else body
+    return hashlib.sha1(f"{request.method.upper()} {request.url} ".encode("utf-8") + hashlib.sha1(body).digest()).hexdigest()
+
+
+class RecordedRaw():
+    # Wraps `response.raw`, to save the body as the run reads it through `iter_content`.
+
+    def __init__(self, raw, path):
+        self.raw = raw
+        self.path = path
+        open(path, "wb").close()
+
+    def stream(self, *args, **kwargs):
+        with open(self.path, "ab", buffering=0) as f:
+            for chunk in self.raw.stream(*args, **kwargs):
+                f.write(chunk)
+                yield chunk
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class Archive():
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.responses = {}
+        if os.path.exists(responses_path := os.path.join(path, "responses.json")):
+            with open(responses_path) as f:
+                self.responses = json.load(f)
+
+    def record(self, session):
+        # Saves the responses of `session` as they are received.
+        os.makedirs(os.path.join(self.path, "bodies"), exist_ok=True)
+        session.hooks["response"].append(self.save_response)
+
+    def save_response(self, response, **kwargs):
+        # The body is saved only as it is read, so that the run reads as much of it as without recording.
+        key = get_key(response.request)
+        response.raw = RecordedRaw(response.raw, os.path.join(self.path, "bodies", key))
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in DROPPED_HEADERS}
+        with self.lock:
+            self.responses[key] = {"method": response.request.method, "url": response.request.url, "status": response.status_code, "headers": headers}
+
+    def save_state(self, config, stored):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "state.pickle"), "wb") as f:
+            pickle.dump({"config": config, "stored": stored}, f)
+
+    def load_state(self):
+        with open(os.path.join(self.path, "state.pickle"), "rb") as f:
+            return pickle.load(f)
+
+    def save(self):
+        with self.lock, open(os.path.join(self.path, "responses.json"), "w") as f:
+            json.dump(self.responses, f, indent=2)
+
+
+class ReplayAdapter(BaseAdapter):
+    # Answers the requests with the responses in `archive`, without the network.
+
+    def __init__(self, archive):
+        super().__init__()
+        self.archive = archive
+
+    def send(self, request, **kwargs):
+        if (entry := self.archive.responses.get(key := get_key(request))) is None:
+            raise requests.exceptions.ConnectionError(f"Not recorded: {request.method} {request.url}", request=request)
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = open(os.path.join(self.archive.path, "bodies", key), "rb")
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class NullAdapter(BaseAdapter):
+    # Answers every request with `{"ok": true}`, like a Telegram Bot API which accepts all the messages.
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.headers = CaseInsensitiveDict({"Content-Type": "application/json"})
+        response.raw = io.BytesIO(json.dumps({"ok": True, "result": {}}).encode("utf-8"))
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
@@ -0,0 +1,159 @@
+# coding: utf-8
+
+import datetime
+import hashlib
+import json
+import yaml
+from loguru import logger
+from common.merge_dict import merge_dict
+
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+FEED_FIELDS = set(["name", "url", "id", "fields", "expand_from", "interval", "source_type", "method", "request_args", "item_xpath", "xpath", "id_retention", "stream", "parse_in_process", "max_bytes",])
+GROUP_FIELDS = set(["name", "feeds", "message_config", "sort_key", "default_sort_key", "id", "fields",])
+# The arguments of `common.session.Session`.
+HTTP_CONFIG_FIELDS = set(["pool_connections", "pool_maxsize", "timeout", "retries", "backoff_factor",])
+
+# The config posted to `/setConfig` is resolved once, and stored in Redis under `resolved_config:<version>` in a compact form:
+# {
+#     ... (top-level fields other than `feeds` and `rssgroups`),
+#     "version": sha1 of the posted config,
+#     "feeds": {feed_name: feed config with `expand_from` resolved},
+#     "group_configs": [the merged configs of groups, each stored once],
+#     "group_feeds": {group_name: [[feed_name, index in `group_configs`], ...]},
+# }
+# `load_config` turns it back into `group_feeds: {group_name: [(feed_name, group_config), ...]}`, in which the same merged config is shared.
+# Names of feeds, groups and chats are strings, as they would be as the keys of the JSON anyway (e.g. `name: 123`).
+
+
+def get_config_version(data):
+    return hashlib.sha1(data if isinstance(data, bytes) else data.encode("utf-8")).hexdigest()
+
+
+def resolve_feeds(config):
+    feeds = {}
+    for feed in config.get("feeds", []):
+        if (name := feed.get("name")) is None:
+            logger.error("No name for the feed.")
+            logger.debug(f"{feed=}")
+            continue
+        name = str(name)
+        expand_from = feed.get("expand_from")
+        if expand_from is not None:
+            if not isinstance(expand_from, list):
+                logger.warning(f"`expand_from` of feed {name} is of type `{type(expand_from)}`, should be a list.")
+            else:
+                for from_feed in map(str, reversed(expand_from)):
+                    if from_feed not in feeds:
+                        logger.error(f"Unknown feed {from_feed} to expand from. Asked by {feed.get('name')}.")
+                        logger.debug(f"{feed=}")
+                    else:
+                        feed = merge_dict(feeds[from_feed], feed)
+
+        if len(ukn_fields := (set(feed.keys()) - FEED_FIELDS)):
+            logger.error(f"Feed {name} have unknown fields: {', '.join(ukn_fields)}.")
+
+        feeds[name] = feed | {"name": name}
+    return feeds
+
+
+def resolve_group_feeds(config, feeds):
+    # Returns the merged configs, and the feeds of each group with the index of their merged configs.
+    group_configs = [{}]
+    # A merged config is shared by all the feeds merged from the same config with the same group.
+    merged = {}
+    group_feeds = {name: [(name, 0)] for name, feed in feeds.items() if "url" in feed}
+    for group in config.get("rssgroups", []):
+        group_name = group.get("name")
+        if not group_name:
+            logger.error(f"The group does not have a name. {group=}")
+            continue
+        group_name = str(group_name)
+        if group_name in group_feeds:
+            logger.warning(f"Repeat group `{group_name}`. Will append the previous one.")
+
+        if not group.get("feeds"):
+            logger.warning(f"No feeds in group `{group_name}`.")
+            continue
+
+        if len(ukn_fields := (set(group.keys()) - GROUP_FIELDS)):
+            logger.error(f"Group {group_name} have unknown fields: {', '.join(ukn_fields)}.")
+
+        for group_feed in map(str, group.get("feeds", [])):
+            if group_feed in group_feeds:
+                for _name, _config in group_feeds[group_feed]:
+                    if (key := (_config, id(group))) not in merged:
+                        merged[key] = len(group_configs)
+                        group_configs.append(merge_dict(group_configs[_config], group))
+                    group_feeds.setdefault(group_name, []).append((_name, merged[key]))
+            else:
+                logger.error(f"Unrecognised feed `{group_feed}` in group `{group_name}`. Skipped.")
+    return group_configs, group_feeds
+
+
+def resolve_config(data):
+    # `data` is the posted YAML.
+    if not isinstance(config := yaml.load(data, YAML_LOADER) or {}, dict):
+        raise ValueError("The config should be a mapping.")
+    # Refused here rather than failing to create the sessions when the config is loaded.
+    if not isinstance(http_config := config.get("http_config", {}), dict):
+        raise ValueError("`http_config` should be a mapping.")
+    if ukn_fields := set(http_config) - HTTP_CONFIG_FIELDS:
+        raise ValueError(f"`http_config` has unknown fields: {', '.join(map(str, ukn_fields))}.")
+    feeds = resolve_feeds(config)
+    group_configs, group_feeds = resolve_group_feeds(config, feeds)
+    if isinstance(chats := config.get("chats"), dict):
+        config["chats"] = {str(chat_id): str(group_name) for chat_id, group_name in chats.items()}
+    return {key: value for key, value in config.items() if key not in ["feeds", "rssgroups"]} | {
+        "version": get_config_version(data),
+        "feeds": feeds,
+        "group_configs": group_configs,
+        "group_feeds": group_feeds,
+    }
+
+
+def to_json(value):
+    # YAML scalars without a JSON type. Dates like `2022-04-25` are kept as ISO strings, the rest are refused.
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    raise ValueError(f"Unsupported value in the config: {value!r}.")
+
+
+def dump_config(config):
+    return json.dumps(config, ensure_ascii=False, separators=(",", ":"), default=to_json)
+
+
+def load_config(resolved):
+    config = json.loads(resolved)
+    group_configs = config.pop("group_configs")
+    config["group_feeds"] = {
+        group_name: [(feed_name, group_configs[idx]) for feed_name, idx in feeds]
+        for group_name, feeds in config["group_feeds"].items()
+    }
+    return config
+
+
+def save_config(r, data):
+    # Saves the posted config and its resolved form. Returns the resolved config.
+    config = resolve_config(data)
+    old_version = r.get("config_version")
+    with r.pipeline() as pipe:
+        pipe.set("config", data)
+        pipe.set(f"resolved_config:{config['version']}", dump_config(config))
+        pipe.set("config_version", config["version"])
+        if old_version and old_version != config["version"]:
+            pipe.delete(f"resolved_config:{old_version}")
+        pipe.execute()
+    return config
+
+
+def get_config(r):
+    # The resolved config of the current version. Configs saved by older versions are resolved here.
+    if (version := r.get("config_version")) and (resolved := r.get(f"resolved_config:{version}")):
+        return load_config(resolved)
+    if data := r.get("config"):
+        try:
+            return load_config(dump_config(save_config(r, data)))
+        except Exception as e:
+            # Not to stop the bot (which imports the config in `const.py`) from starting, e.g. to `/setConfig` again.
+            logger.error(f"Cannot resolve the stored config. Use an empty config instead. Error `{e}`.")
+    return load_config(dump_config(resolve_config("")))
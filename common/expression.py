@@ -0,0 +1,41 @@
+# coding: utf-8
+
+import functools
+import types
+from loguru import logger
+
+
+class Expression():
+    # Python code in the config (`id`, `sort_key`, ...), compiled once and evaluated for every item.
+
+    def __init__(self, source):
+        self.source = source
+        try:
+            self.code = compile(source, "<config>", "eval")
+        except SyntaxError as e:
+            # Only reported here, once for each expression.
+            logger.error(f"Failed to compile `{source}`. Error `{e}`.")
+            self.code = None
+            self.error = e
+        else:
+            # Comprehensions and lambdas have their own scopes, in which only the globals can be seen,
+            # so the names have to be merged into one dict for them.
+            self.flat = any(isinstance(const, types.CodeType) for const in self.code.co_consts)
+
+    def eval(self, globals, locals=None):
+        if self.code is None:
+            raise self.error.with_traceback(None)
+        if locals is None:
+            return eval(self.code, globals)
+        if self.flat:
+            return eval(self.code, globals | dict(locals))
+        return eval(self.code, globals, locals)
+
+
+@functools.lru_cache(maxsize=None)
+def get_expression(source: str):
+    return Expression(source)
+
+
+def eval_expression(source: str, globals: dict, locals=None):
+    return get_expression(source).eval(globals, locals)
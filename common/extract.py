@@ -0,0 +1,43 @@
+# coding: utf-8
+
+from const import source_type_class_map
+
+# Extracting the fields of the items of a parsed document.
+# `extract_items` also runs in the processes of `fetch_config.parse_processes`: the content goes in and plain strings
+# come out, so that lxml trees never cross the process boundary.
+
+
+class ExtractedFeed():
+    # A document parsed and extracted by `extract_items`.
+
+    def __init__(self, ttl, items):
+        self.ttl = ttl
+        # `(fields, failures)` of each item, see `extract_fields`.
+        self.items = items
+
+
+def get_ttl(doc, source_type):
+    # The `<ttl>` of a RSS feed, in minutes.
+    if source_type == "XML" and len(ttl := source_type_class_map[source_type].get_xpath(doc, "/rss/channel/ttl/text()")) == 1 and ttl[0].isdigit():
+        return int(ttl[0])
+
+
+def extract_fields(item, fields_xpath, source_type):
+    # Returns the fields of the item, and `(key, num)` for each field not found exactly once.
+    scls = source_type_class_map[source_type]
+    fields, failures = {}, []
+    for key, xpath in fields_xpath:
+        if len(field := scls.get_xpath(item, xpath)) != 1:
+            failures.append((key, len(field)))
+            fields[key] = None
+        else:
+            fields[key] = field[0]
+    return fields, failures
+
+
+def extract_items(source_type, content, item_xpath, fields_xpath):
+    # Returns an `ExtractedFeed`, or None if the content cannot be parsed.
+    scls = source_type_class_map[source_type]
+    if (doc := scls.parse_from_url(content)) is None:
+        return None
+    return ExtractedFeed(get_ttl(doc, source_type), [extract_fields(item, fields_xpath, source_type) for item in scls.get_xpath(doc, item_xpath)])
@@ -1,9 +1,11 @@
 # coding: utf-8
 
+import functools
 import html
 import re
 import string
 from loguru import logger
+from common.expression import eval_expression
 
 
 def escape_markdown(text: str, version: int = 1) -> str:
@@ -18,28 +20,59 @@ def escape_markdown(text: str, version: int = 1) -> str:
     return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
 
 
+ESCAPE_FUNCS = {
+    "Markdown": lambda s: escape_markdown(str(s)),
+    "MarkdownV2": lambda s: escape_markdown(str(s), 2),
+    "HTML": lambda s: html.escape(str(s)),
+    "": lambda s: s,
+}
+
+
 class EscapeFstringFormatter(string.Formatter):
 
     def __init__(self, mtype, kwargs=None):
-        match mtype:
-            case "Markdown":
-                self.escape_func = lambda s: escape_markdown(str(s))
-            case "MarkdownV2":
-                self.escape_func = lambda s: escape_markdown(str(s), 2)
-            case "HTML":
-                self.escape_func = lambda s: html.escape(str(s))
-            case "":
-                self.escape_func = lambda s: s
-            case _:
-                raise ValueError(f"Unsupported message type `{mtype}`")
+        if (escape_func := ESCAPE_FUNCS.get(mtype)) is None:
+            raise ValueError(f"Unsupported message type `{mtype}`")
+        self.escape_func = escape_func
         self.kwargs = kwargs
 
     def get_field(self, field_name, args, kwargs):
         if args:
             raise ValueError("`EscapeFstringFormatter` does not support positional arguments.")
-        return eval(field_name, self.kwargs | kwargs), field_name
+        return eval_expression(field_name, self.kwargs or {}, kwargs), field_name
 
     def convert_field(self, value, convension):
         if convension == "n":
             return value
         return self.escape_func(super().convert_field(value, convension))
+
+
+class CompiledTemplate():
+    # A template parsed once, which renders the same as `EscapeFstringFormatter(mtype, kwargs).format(template, **item)`.
+
+    def __init__(self, template, mtype):
+        self.template = template
+        self.mtype = mtype
+        self.formatter = EscapeFstringFormatter(mtype)
+        self.parts = []
+        for literal_text, field_name, format_spec, conversion in self.formatter.parse(template):
+            if field_name is not None and (not field_name or field_name[0].isdigit() or "{" in format_spec):
+                # Positional arguments and nested fields in format specs are left to `EscapeFstringFormatter`.
+                self.parts = None
+                break
+            self.parts.append((literal_text, field_name, format_spec, conversion))
+
+    def render(self, kwargs, item):
+        if self.parts is None:
+            return EscapeFstringFormatter(self.mtype, kwargs).format(self.template, **item)
+        result = []
+        for literal_text, field_name, format_spec, conversion in self.parts:
+            result.append(literal_text)
+            if field_name is not None:
+                result.append(format(self.formatter.convert_field(eval_expression(field_name, kwargs, item), conversion), format_spec))
+        return "".join(result)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_template(template: str, mtype: str):
+    return CompiledTemplate(template, mtype)
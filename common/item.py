@@ -0,0 +1,94 @@
+# coding: utf-8
+
+from collections.abc import Mapping
+
+# Items are read-only mappings, used as the locals of `eval` and to render messages.
+# `Item` extracts each field from the node only when it is first looked up, so that items sent before are dropped
+# after extracting their id alone. `GroupItem` adds the fields of a group by reference, without copying anything.
+
+
+class Item(Mapping):
+    # The fields extracted from `node` with `xpaths` (key -> xpath), over the `fields` of the feed.
+    __slots__ = ("node", "scls", "xpaths", "defaults", "on_failure", "fields")
+
+    def __init__(self, node, scls, xpaths, defaults, on_failure=None, fields=None):
+        self.node = node
+        self.scls = scls
+        self.xpaths = xpaths
+        self.defaults = defaults
+        # Called with the key and the number of nodes found, for a field not found exactly once.
+        self.on_failure = on_failure
+        self.fields = {} if fields is None else fields
+
+    def extract(self, key):
+        if len(field := self.scls.get_xpath(self.node, self.xpaths[key])) != 1:
+            if self.on_failure is not None:
+                self.on_failure(key, len(field))
+            value = None
+        else:
+            value = field[0]
+        self.fields[key] = value
+        return value
+
+    def materialize(self):
+        # Extracts all the fields and lets the node go, e.g. before a stream frees it.
+        if self.node is not None:
+            for key in self.xpaths:
+                if key not in self.fields:
+                    self.extract(key)
+            self.node = None
+        return self
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            return self.fields[key]
+        if self.node is not None and key in self.xpaths:
+            return self.extract(key)
+        return self.defaults[key]
+
+    def __iter__(self):
+        return iter(dict.fromkeys([*self.defaults, *self.xpaths, *self.fields]))
+
+    def __len__(self):
+        return len(dict.fromkeys([*self.defaults, *self.xpaths, *self.fields]))
+
+    def extracted(self):
+        # The fields extracted so far, without extracting the others.
+        return self.defaults | self.fields
+
+    def __repr__(self):
+        # Only the fields extracted so far, so that logging an item does not extract (and report failures of) the others.
+        return repr(self.extracted())
+
+
+class GroupItem(Mapping):
+    # An item as sent by a group: the item over the `fields` of the group, over `feed_config` and `group_config`.
+    __slots__ = ("item", "feed_config", "group_config")
+
+    def __init__(self, item, feed_config, group_config):
+        self.item = item
+        self.feed_config = feed_config
+        self.group_config = group_config
+
+    def __getitem__(self, key):
+        try:
+            return self.item[key]
+        except KeyError:
+            pass
+        if key in (fields := self.group_config.get("fields", {})):
+            return fields[key]
+        if key == "feed_config":
+            return self.feed_config
+        if key == "group_config":
+            return self.group_config
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(dict.fromkeys(["feed_config", "group_config", *self.group_config.get("fields", {}), *self.item]))
+
+    def __len__(self):
+        return len(dict.fromkeys(["feed_config", "group_config", *self.group_config.get("fields", {}), *self.item]))
+
+    def __repr__(self):
+        # Without the configs, which are long and the same for all the items. See `Item.__repr__`.
+        return repr(self.group_config.get("fields", {}) | self.item.extracted())
@@ -0,0 +1,72 @@
+# coding: utf-8
+
+import json
+import threading
+import time
+from collections import Counter
+from const import r, RUN_SUMMARIES
+
+# Timings and sizes of a run are accumulated in `report["stats"]` as `{kind: {key: Counter}}`,
+# e.g. `report["stats"]["feeds"][feed_name]["fetch_seconds"]`, from the fetching and sending threads.
+# The `bytes` of a feed are those downloaded, as sent by the server (before decompression).
+# A summary of each run is kept in the Redis list `run_summaries`, newest first, and the last one is served by `/metrics`.
+
+lock = threading.Lock()
+# The label of each kind of stats in `/metrics`.
+LABELS = {"stages": "stage", "feeds": "feed", "chats": "chat"}
+
+
+def add(report, kind, key, **values):
+    with lock:
+        report.setdefault("stats", {}).setdefault(kind, {}).setdefault(key, Counter()).update(values)
+
+
+def lap(report, stage, started_at):
+    # Adds the time since `started_at` to `stage`, and returns the start of the next stage.
+    now = time.perf_counter()
+    add(report, "stages", stage, seconds=now - started_at)
+    return now
+
+
+def merge(stats, other):
+    for kind, entries in other.items():
+        for key, values in entries.items():
+            stats.setdefault(kind, {}).setdefault(key, Counter()).update(values)
+    return stats
+
+
+def save_summary(report):
+    with r.pipeline() as pipe:
+        pipe.lpush("run_summaries", json.dumps({
+            "start_at": report["start_at"].timestamp(),
+            "stats": report.get("stats", {}),
+        }))
+        pipe.ltrim("run_summaries", 0, RUN_SUMMARIES - 1)
+        pipe.execute()
+
+
+def get_summaries(num=RUN_SUMMARIES):
+    return [json.loads(summary) for summary in r.lrange("run_summaries", 0, num - 1)]
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def to_prometheus(summaries):
+    # `summaries` as returned by `get_summaries`, newest first.
+    # https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+    # The stats of the last run, as gauges.
+    if not summaries:
+        return ""
+    lines = ["# TYPE rss_bot_last_run_timestamp_seconds gauge", f"rss_bot_last_run_timestamp_seconds {summaries[0]['start_at']}"]
+    metrics = {}
+    for kind, entries in summaries[0]["stats"].items():
+        label = LABELS.get(kind, kind)
+        for key, values in entries.items():
+            for name, value in values.items():
+                metrics.setdefault(f"rss_bot_{label}_{name}", []).append(f'{{{label}="{escape_label(key)}"}} {value}')
+    for metric, samples in sorted(metrics.items()):
+        lines.append(f"# TYPE {metric} gauge")
+        lines.extend(metric + sample for sample in samples)
+    return "\n".join(lines) + "\n"
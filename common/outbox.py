@@ -0,0 +1,75 @@
+# coding: utf-8
+
+import json
+import redis
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from const import r, MAX_SEND_WORKERS, OUTBOX_LOCK_TIMEOUT
+
+# Messages rendered by the fetch job are queued in Redis, one list per chat, and delivered by `drain`.
+# A message is moved to `outbox:<chat_id>:sending` while it is being sent, and removed from there once sent.
+# If the process dies in between, the message is put back at the front of the queue by the next `drain`,
+# so every message is delivered at least once, and at most one message per chat can be sent twice.
+
+
+def enqueue(pipe, chat_id, messages):
+    # Queue the messages in the same transaction as the rest of the state of the run (e.g. the sent item ids).
+    if messages:
+        pipe.lpush(f"outbox:{chat_id}", *[json.dumps(message) for message in messages])
+        pipe.sadd("outbox_chats", chat_id)
+
+
+def drain_chat(chat_id, deliver, stop=None):
+    queue, sending = f"outbox:{chat_id}", f"outbox:{chat_id}:sending"
+    # Only one process sends to a chat at a time, to keep the messages in order.
+    lock = r.lock(f"outbox_lock:{chat_id}", timeout=OUTBOX_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        logger.info(f"Messages to chat {chat_id} are being sent by another process.")
+        return
+    try:
+        # Messages left by a previous process which died while sending them.
+        if left := r.lrange(sending, 0, -1):
+            with r.pipeline() as pipe:
+                pipe.rpush(queue, *left)
+                pipe.delete(sending)
+                pipe.execute()
+        while (stop is None or not stop.is_set()) and (message := r.rpoplpush(queue, sending)) is not None:
+            deliver(chat_id, json.loads(message))
+            r.lrem(sending, 1, message)
+            try:
+                lock.reacquire()
+            except redis.exceptions.LockError:
+                # Expired while sending (e.g. a long `retry_after`), and maybe taken by another process which goes on.
+                logger.warning(f"Lost the lock of chat {chat_id} while sending. Leave the rest of the messages.")
+                return
+        forget_chat(chat_id)
+    except Exception as e:
+        # Left in `sending` and retried by the next `drain`.
+        logger.error(f"Failed to send messages to chat {chat_id}. Error `{e}`.")
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            pass
+
+
+def forget_chat(chat_id):
+    # Removes a chat with nothing left to send from `outbox_chats`, unless messages are queued meanwhile.
+    with r.pipeline() as pipe:
+        try:
+            pipe.watch(queue := f"outbox:{chat_id}", sending := f"outbox:{chat_id}:sending")
+            if not pipe.llen(queue) and not pipe.llen(sending):
+                pipe.multi()
+                pipe.srem("outbox_chats", chat_id)
+                pipe.execute()
+        except redis.exceptions.WatchError:
+            pass
+
+
+def drain(deliver, max_workers=MAX_SEND_WORKERS, stop=None):
+    # Chats are independent of each other, so they are sent to in parallel, each in its own order.
+    # `deliver(chat_id, message)` should only raise if the message should be sent again.
+    # Once `stop` is set, the messages being sent are finished and the rest are left queued.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(drain_chat, chat_id, deliver, stop) for chat_id in r.smembers("outbox_chats")]:
+            future.result()
@@ -0,0 +1,69 @@
+# coding: utf-8
+
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+
+# `profile(path)` profiles the calls and traces the Python allocations of a block, and saves into `path`:
+#   calls.prof: the stats of cProfile, e.g. for `python -m pstats` or snakeviz. Threads started in the block (e.g. those
+#     fetching the feeds and sending the messages) are profiled as well, and merged into the same stats.
+#   profile.txt: the functions taking the most time, and the lines allocating the most memory still held at the end.
+# While tracing, `scripts/fetch.py` also records the peak allocations while extracting each feed (`extract_process_alloc_bytes`).
+# tracemalloc is process-wide, so these include the allocations of the feeds still being fetched and parsed meanwhile.
+
+TOP = 40
+
+
+@contextlib.contextmanager
+def profile(path):
+    os.makedirs(path, exist_ok=True)
+    # Before Python 3.12, a profiler only sees the thread it is enabled in.
+    profilers = [cProfile.Profile()]
+    lock = threading.Lock()
+
+    def profile_thread(*args):
+        # Called first thing in each new thread, and replaced by a profiler of the thread.
+        with lock:
+            profilers.append(profiler := cProfile.Profile())
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+, where the profiler of the block already sees all the threads.
+            sys.setprofile(None)
+
+    tracemalloc.start()
+    threading.setprofile(profile_thread)
+    profilers[0].enable()
+    try:
+        yield
+    finally:
+        profilers[0].disable()
+        threading.setprofile(None)
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with lock:
+            stats = pstats.Stats(*profilers)
+        stats.dump_stats(os.path.join(path, "calls.prof"))
+        stream = io.StringIO()
+        stream.write(f"Peak allocated: {peak / 1024:.1f} KiB\n\nAllocated, by line:\n")
+        for stat in snapshot.statistics("lineno")[:TOP]:
+            stream.write(f"  {stat}\n")
+        stream.write("\nCalls, by cumulative time:\n")
+        stats.stream = stream
+        stats.sort_stats("cumulative").print_stats(TOP)
+        with open(os.path.join(path, "profile.txt"), "w") as f:
+            f.write(stream.getvalue())
+
+
+def get_allocated():
+    # The current size of the traced allocations and their peak since the last call, or None if not tracing.
+    if tracemalloc.is_tracing():
+        allocated = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        return allocated
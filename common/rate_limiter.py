@@ -0,0 +1,58 @@
+# coding: utf-8
+
+import threading
+import time
+from collections import defaultdict
+
+
+class TokenBucket():
+
+    def __init__(self, rate: float, capacity: float = 1):
+        # `rate` tokens are added every second, up to `capacity`.
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1):
+        # Wait until there are enough tokens, and take them. More tokens than `capacity` can be taken, leaving a debt to be paid before the next time.
+        # Returns the time waited in seconds.
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if (wait := max(self.blocked_until - now, (min(tokens, self.capacity) - self.tokens) / self.rate)) <= 0:
+                    self.tokens -= tokens
+                    return waited
+            time.sleep(wait)
+            waited += wait
+
+    def block(self, seconds: float):
+        # Nothing can be acquired in `seconds` seconds, e.g. after a `retry_after`.
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = min(self.tokens, 0)
+
+
+class RateLimiter():
+    # A bucket shared by all chats, plus one for each chat.
+
+    def __init__(self, rate: float, chat_rate: float):
+        self.bucket = TokenBucket(rate, capacity=rate)
+        self.chat_buckets = defaultdict(lambda: TokenBucket(chat_rate))
+        self.lock = threading.Lock()
+
+    def get_chat_bucket(self, chat_id):
+        with self.lock:
+            return self.chat_buckets[chat_id]
+
+    def acquire(self, chat_id, tokens: float = 1):
+        # Wait for the chat first, so that a chat waiting for its turn does not hold tokens from others.
+        return self.get_chat_bucket(chat_id).acquire(tokens) + self.bucket.acquire(tokens)
+
+    def block(self, chat_id, seconds: float):
+        self.get_chat_bucket(chat_id).block(seconds)
@@ -0,0 +1,134 @@
+# coding: utf-8
+
+import hashlib
+from collections import defaultdict
+
+# Each feed is due at `phase + k * period` (timestamps in seconds), where the period is its interval, and the phase is a
+# stable offset from the hash of its name. Feeds with the same interval are thus spread evenly, and each feed is fetched
+# at a regular pace however often the task runs.
+# The next due times are kept in the sorted set `feed_schedule`.
+# The period is `max(interval, ttl) * backoff`, where `ttl` is the `<ttl>` of a RSS feed, and `backoff` grows each time
+# a fetch finds nothing new, and is reset once something new is found.
+# A feed which fails `threshold` times in a row (see `CIRCUIT_BREAKER` in `const.py`) is not fetched for a cooldown, which
+# doubles with each further failure. After the cooldown it is fetched once as a probe, and back on its grid if that succeeds.
+# The numbers of failures in a row are kept in the hash `feed_failures`.
+
+# Number of the results of `queue_schedule`.
+NUM_COMMANDS = 5
+
+
+def get_phase(name: str, period: int):
+    return int(hashlib.md5(name.encode("utf-8")).hexdigest(), 16) % period
+
+
+def get_shard(name: str, num_shards: int):
+    # The shard (1 to `num_shards`) which fetches the feed, by rendezvous hashing: adding or removing a shard moves only
+    # the feeds of that shard.
+    return max(range(1, num_shards + 1), key=lambda shard: hashlib.md5(f"{shard}:{name}".encode("utf-8")).digest())
+
+
+def get_shards(groups, num_shards):
+    # `groups`: lists of feed names sent together. Feeds in the same list, or linked through other lists, go to the same
+    # shard, so that the items of a group are deduplicated and sorted as a whole. Returns `{name: shard}`.
+    parents = {}
+
+    def find(name):
+        while (parent := parents.setdefault(name, name)) != name:
+            parents[name] = parents[parent]
+            name = parents[name]
+        return name
+
+    for names in groups:
+        for name in names:
+            parents[find(name)] = find(names[0])
+    components = defaultdict(list)
+    for name in parents:
+        components[find(name)].append(name)
+    # Keyed by the least name, which stays the same while the component does.
+    return {name: get_shard(min(names), num_shards) for names in components.values() for name in names}
+
+
+def get_period(interval, ttl=None, backoff=1):
+    return max(60, int(max(interval, ttl or 0) * backoff * 60))
+
+
+def get_next_fetch_time(name: str, period: int, now: float):
+    # The time on the grid of the feed closest to one period after now.
+    phase = get_phase(name, period)
+    return phase + round((now + period - phase) / period) * period
+
+
+def queue_schedule(pipe):
+    # Queues the reads of the schedule on `pipe`, whose `NUM_COMMANDS` results are parsed by `parse_schedule`.
+    pipe.zrange("feed_schedule", 0, -1, withscores=True)
+    pipe.hgetall("last_fetch_time")
+    pipe.hgetall("feed_backoff")
+    pipe.hgetall("feed_ttl")
+    pipe.hgetall("feed_failures")
+
+
+def parse_schedule(results):
+    next_fetch_time, last_fetch_time, backoff, ttl, failures = results
+    return {
+        "next_fetch_time": dict(next_fetch_time),
+        "last_fetch_time": {key: float(value) for key, value in last_fetch_time.items()},
+        "backoff": {key: float(value) for key, value in backoff.items()},
+        "ttl": {key: int(value) for key, value in ttl.items()},
+        "failures": {key: int(value) for key, value in failures.items()},
+    }
+
+
+def get_cooldown(failures, circuit_breaker):
+    # Seconds until the next probe of a feed which has failed `failures` times in a row, or None if its circuit is closed.
+    if failures >= circuit_breaker["threshold"]:
+        return min(circuit_breaker["cooldown"] * 2 ** (failures - circuit_breaker["threshold"]), circuit_breaker["max_cooldown"]) * 60
+
+
+def get_open_circuits(schedule, circuit_breaker):
+    # `{name: failures}` of the feeds not fetched until their cooldowns end.
+    return {
+        name: failures
+        for name, failures in schedule["failures"].items()
+        if get_cooldown(failures, circuit_breaker) is not None
+    }
+
+
+def get_due_times(schedule, intervals):
+    # Feeds never scheduled before are due one interval after their last fetch, or right now if never fetched.
+    return {
+        name: schedule["next_fetch_time"].get(name, schedule["last_fetch_time"].get(name, 0) + interval * 60)
+        for name, interval in intervals.items()
+    }
+
+
+def update_schedule(pipe, schedule, fetched, intervals, now, max_backoff, failed=(), circuit_breaker=None, skipped=()):
+    # `fetched` maps the name of each fetched feed to whether new items were found, and `failed` are the ones which failed.
+    # `skipped` feeds were not tried, and are only put back on their grids. Returns the next fetch times.
+    next_fetch_time = {}
+    recovered = []
+    for name, found in fetched.items():
+        if name in failed:
+            failures = schedule["failures"][name] = schedule["failures"].get(name, 0) + 1
+            if circuit_breaker is not None and (cooldown := get_cooldown(failures, circuit_breaker)) is not None:
+                next_fetch_time[name] = now + cooldown
+                continue
+        elif name not in skipped:
+            if schedule["failures"].pop(name, 0):
+                recovered.append(name)
+            # A failed fetch tells nothing about whether the feed has new items, so only the others change the backoff.
+            schedule["backoff"][name] = 1 if found else min(max_backoff, schedule["backoff"].get(name, 1) * 1.5)
+        next_fetch_time[name] = get_next_fetch_time(name, get_period(intervals[name], schedule["ttl"].get(name), schedule["backoff"].get(name, 1)), now)
+    if next_fetch_time:
+        pipe.zadd("feed_schedule", next_fetch_time)
+    if backoff := {name: schedule["backoff"][name] for name in fetched if name not in failed and name not in skipped}:
+        pipe.hset("feed_backoff", mapping=backoff)
+    if failures := {name: schedule["failures"][name] for name in fetched if name in failed}:
+        pipe.hset("feed_failures", mapping=failures)
+    if recovered:
+        pipe.hdel("feed_failures", *recovered)
+    if stale := set(schedule["next_fetch_time"]) - set(intervals):
+        pipe.zrem("feed_schedule", *stale)
+    for key, values in [("last_fetch_time", schedule["last_fetch_time"]), ("feed_backoff", schedule["backoff"]), ("feed_ttl", schedule["ttl"]), ("feed_failures", schedule["failures"])]:
+        if stale := set(values) - set(intervals):
+            pipe.hdel(key, *stale)
+    return next_fetch_time
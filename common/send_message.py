@@ -1,67 +1,147 @@
 # coding: utf-8
 
 import json
-import requests
-import datetime
+import itertools
+import threading
 import time
-from collections import defaultdict, Counter
+from collections import Counter
 from loguru import logger
-from const import MESSAGE_FORMAT, MESSAGE_TYPE, FUNCS
-from common.formatter import EscapeFstringFormatter
+from const import MESSAGE_FORMAT, MESSAGE_TYPE, FUNCS, MESSAGES_PER_SECOND, MESSAGES_PER_MINUTE_PER_CHAT, TELEGRAM_API_URL, MAX_MESSAGE_LENGTH, MAX_MEDIA_GROUP_SIZE
+from common.formatter import compile_template
+from common.rate_limiter import RateLimiter
+from common import metrics
+from common.session import telegram_session
 
 
-last_time_send_message = datetime.datetime(1, 1, 1)
-last_time_send_message_by_chat = defaultdict(lambda: datetime.datetime(1, 1, 1))
-last_num_message = 1
-last_num_message_by_chat = defaultdict(lambda: 1)
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+rate_limiter = RateLimiter(MESSAGES_PER_SECOND, MESSAGES_PER_MINUTE_PER_CHAT / 60)
+report_lock = threading.Lock()
+# The types of messages which can be packed into an album, and the arg of their media.
+MEDIA_TYPES = {"Photo": "photo", "Video": "video", "Document": "document", "Audio": "audio"}
 
 
-def sleep_until(until: datetime.datetime):
-    while (now := datetime.datetime.now()) < until:
-        time.sleep((until - now).total_seconds())
-    return datetime.datetime.now()
+def split_message(parts, max_length=MAX_MESSAGE_LENGTH, separator="\n", max_parts=None):
+    # Joins the parts into as few strings as possible, each no longer than `max_length` and of at most `max_parts` parts.
+    # A part longer than `max_length` is left on its own.
+    messages = []
+    cur, num = None, 0
+    for part in parts:
+        if cur is not None and len(cur) + len(separator) + len(part) <= max_length and (max_parts is None or num < max_parts):
+            cur, num = cur + separator + part, num + 1
+        else:
+            if cur is not None:
+                messages.append(cur)
+            cur, num = part, 1
+    if cur is not None:
+        messages.append(cur)
+    return messages
 
 
-def _send_message(bot_token: str, chat_id: str, message_type: str=MESSAGE_TYPE, **kwargs):
-    # https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
-    global last_time_send_message, last_time_send_message_by_chat, last_num_message, last_num_message_by_chat
-    last_time_send_message = sleep_until(last_time_send_message + datetime.timedelta(seconds=0.05 * last_num_message))
-    last_time_send_message_by_chat[chat_id] = sleep_until(last_time_send_message_by_chat[chat_id] + datetime.timedelta(seconds=3 * last_num_message_by_chat[chat_id]))
+def get_num_messages(message_type: str, kwargs):
     if message_type == "MediaGroup":
-        last_num_message = max(1, len(json.loads(kwargs.get("media", "[]"))))
-    else:
-        last_num_message = 1
-    last_num_message_by_chat[chat_id] = last_num_message
-    return requests.get(f"https://api.telegram.org/bot{bot_token}/send{message_type}", params={"chat_id": chat_id} | kwargs)
+        return max(1, len(json.loads(kwargs.get("media", "[]"))))
+    return 1
 
 
-def send_message(bot_token: str, chat_id: str, item, config, report=None):
-    message_config = config.get("message_config", {})
-    message_type = message_config.get("type", MESSAGE_TYPE)
-    message_args = ({"text": MESSAGE_FORMAT} if message_type == MESSAGE_TYPE else {}) | message_config.get("args", {})
-    parse_mode = message_args.get("parse_mode", "")
-
-    ret = _send_message(
-        bot_token, chat_id, message_type,
-        **{
-            k: EscapeFstringFormatter(
-                parse_mode
-                if k in ["text", "caption"]
-                else "", FUNCS
-            ).format(v, **item)
+def _send_message(bot_token: str, chat_id: str, message_type: str=MESSAGE_TYPE, **kwargs):
+    rate_limiter.acquire(chat_id, get_num_messages(message_type, kwargs))
+    return _post_message(bot_token, chat_id, message_type, **kwargs)
+
+
+def _post_message(bot_token: str, chat_id: str, message_type: str=MESSAGE_TYPE, **kwargs):
+    return telegram_session.post(f"{TELEGRAM_API_URL}/bot{bot_token}/send{message_type}", data={"chat_id": chat_id} | kwargs)
+
+
+class MessageRenderer():
+    # Renders items into messages with the `message_config` of a group, with the templates compiled once.
+
+    def __init__(self, config):
+        message_config = config.get("message_config", {})
+        self.message_type = message_config.get("type", MESSAGE_TYPE)
+        # `batch: true` for the defaults.
+        self.batch = {} if (batch := message_config.get("batch")) is True else batch if isinstance(batch, dict) else None
+        message_args = ({"text": MESSAGE_FORMAT} if self.message_type == MESSAGE_TYPE else {}) | message_config.get("args", {})
+        parse_mode = message_args.get("parse_mode", "")
+        self.templates = [
+            (k, compile_template(v, parse_mode if k in ["text", "caption"] else ""))
             for k, v in message_args.items()
+        ]
+
+    def render(self, item):
+        return {
+            "type": self.message_type,
+            "args": {k: template.render(FUNCS, item) for k, template in self.templates},
         }
-    )
 
-    if report is not None and "send_message_errors" not in report:
-        report["send_message_errors"] = Counter()
+    def pack(self, messages):
+        # Packs the messages rendered by `render` into fewer ones, see `message_config.batch`.
+        # The texts of `Message`s are joined, and `Photo`s, `Video`s, etc. are sent as albums. The other args are the ones of the first message.
+        max_items = self.batch.get("max_items", MAX_MEDIA_GROUP_SIZE)
+        if self.message_type == MESSAGE_TYPE:
+            texts = split_message([message["args"].get("text", "") for message in messages], MAX_MESSAGE_LENGTH, self.batch.get("separator", "\n\n"), max_items)
+            yield from ({"type": self.message_type, "args": messages[0]["args"] | {"text": text}} for text in texts)
+        elif (media_type := MEDIA_TYPES.get(self.message_type)) is not None:
+            max_items = min(max_items, MAX_MEDIA_GROUP_SIZE)
+            for album in (messages[idx:idx + max_items] for idx in range(0, len(messages), max_items)):
+                if len(album) == 1:
+                    # An album has at least 2 items.
+                    yield album[0]
+                    continue
+                yield {"type": "MediaGroup", "args": {
+                    k: v for k, v in album[0]["args"].items()
+                    if k not in [media_type, "caption", "parse_mode", "caption_entities"]
+                } | {"media": json.dumps([
+                    {"type": media_type, "media": message["args"][media_type]} | {
+                        k: message["args"][k] for k in ["caption", "parse_mode"] if k in message["args"]
+                    }
+                    for message in album
+                ])}}
+        else:
+            yield from messages
+
+
+def render_message(item, config):
+    return MessageRenderer(config).render(item)
+
+
+def render_messages(items):
+    # Renders `(item, config)` pairs, with one renderer for each config.
+    # Consecutive items of a config with `message_config.batch` are packed into fewer messages.
+    renderers = {}
+
+    def _render():
+        for item, config in items:
+            if (renderer := renderers.get(id(config))) is None:
+                renderer = renderers[id(config)] = MessageRenderer(config)
+            yield renderer, renderer.render(item)
+
+    for renderer, rendered in itertools.groupby(_render(), key=lambda pair: pair[0]):
+        messages = [message for _, message in rendered]
+        yield from renderer.pack(messages) if renderer.batch is not None else messages
+
+
+def deliver_message(bot_token: str, chat_id: str, message, report=None):
+    message_type = message["type"]
+    # A message packed from several items (see `MessageRenderer.pack`) is counted as one, and an album as its number of media.
+    waited = rate_limiter.acquire(chat_id, num_messages := get_num_messages(message_type, message["args"]))
+    started_at = time.perf_counter()
+    ret = _post_message(bot_token, chat_id, message_type, **message["args"])
+    if report is not None:
+        metrics.add(report, "chats", chat_id, requests=1, messages=num_messages, send_seconds=time.perf_counter() - started_at, rate_limit_seconds=waited)
+
     if not (ret_json := json.loads(ret.text))["ok"]:
         logger.error(f"Send {message_type} to chat `{chat_id}` failed.")
-        logger.debug(f"{message_args=}")
+        logger.debug(f"message_args={message['args']}")
         logger.debug(f"url={ret.url}")
         logger.debug(f"response={ret.text}")
         if ret_json.get("error_code") == 429 and isinstance((retry_after := ret_json.get("parameters", {}).get("retry_after")), int):
-            time.sleep(retry_after)
-            return send_message(bot_token, chat_id, item, config)
+            # Only this chat waits.
+            rate_limiter.block(chat_id, retry_after)
+            return deliver_message(bot_token, chat_id, message, report)
         if report is not None:
-            report["send_message_errors"][chat_id] += 1
+            with report_lock:
+                report.setdefault("send_message_errors", Counter())[chat_id] += 1
+
+
+def send_message(bot_token: str, chat_id: str, item, config, report=None):
+    return deliver_message(bot_token, chat_id, render_message(item, config), report)
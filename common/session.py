@@ -0,0 +1,33 @@
+# coding: utf-8
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.util.request import ACCEPT_ENCODING
+from const import HTTP_CONFIG
+
+
+class Session(requests.Session):
+    # Keeps connections alive for the whole run (or the whole life of the web process), with a default timeout and retries.
+
+    def __init__(self, pool_connections, pool_maxsize, timeout, retries, backoff_factor):
+        super().__init__()
+        self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+        # The encodings urllib3 can decode: gzip and deflate, and br if `brotli` is installed.
+        self.headers["Accept-Encoding"] = ACCEPT_ENCODING
+        # Only idempotent requests are retried after a response, and errors like 429 are left to the caller.
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[502, 503, 504], raise_on_status=False),
+        )
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+feed_session = Session(**HTTP_CONFIG)
+telegram_session = Session(**HTTP_CONFIG)
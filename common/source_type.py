@@ -2,50 +2,170 @@
 
 from lxml import etree
 import json
+import re
 import requests
+from requests.compat import chardet
+import threading
+from common.expression import eval_expression
+from common.session import feed_session
+from const import CHUNK_SIZE
 
 
 class SourceTypeHTTPRequest():
 
     @classmethod
-    def get_text(cls, method, url, kwargs):
+    def get_response(cls, method, url, kwargs):
         try:
-            return requests.request(method, url, **kwargs).text
+            return feed_session.request(method, url, **kwargs)
         except requests.exceptions.RequestException:
             return
 
+    @classmethod
+    def decode(cls, response, body):
+        # As `response.text`, for a body read in chunks by the caller.
+        encoding = response.encoding or chardet.detect(body)["encoding"] or "utf-8"
+        try:
+            return str(body, encoding, errors="replace")
+        except LookupError:
+            return str(body, errors="replace")
 
-class SourceTypeXML(SourceTypeHTTPRequest):
+    @classmethod
+    def get_content(cls, response, body):
+        # What `parse_from_url` takes from the response, given its (decompressed) body.
+        return cls.decode(response, body)
 
     @classmethod
-    def parse_from_url(cls, text):
-        try:
-            return etree.fromstring(text.encode("utf-8"), etree.XMLParser(encoding="utf-8"))
-        except etree.XMLSyntaxError:
-            return
+    def get_text(cls, method, url, kwargs):
+        if (response := cls.get_response(method, url, kwargs)) is not None:
+            return cls.get_content(response, response.content)
+
+
+class SourceTypeLXML(SourceTypeHTTPRequest):
+    parser_class = None
+    # lxml parsers must not be shared between threads, so each thread keeps its own parsers (and compiled xpaths).
+    local = threading.local()
 
     @classmethod
-    def get_xpath(cls, node, path):
-        return node.xpath(path)
+    def get_content(cls, response, body):
+        # A charset in the headers overrides the one declared in the document. Otherwise, let lxml decode the raw bytes
+        # with the encoding declared in the document (or in `<meta>` for HTML).
+        if "charset" in response.headers.get("Content-Type", "").lower():
+            return cls.decode(response, body)
+        return body
 
+    @classmethod
+    def get_parser(cls, encoding=None):
+        parsers = cls.local.__dict__.setdefault("parsers", {})
+        if (key := (cls.parser_class, encoding)) not in parsers:
+            parsers[key] = cls.parser_class(encoding=encoding)
+        return parsers[key]
 
-class SourceTypeHTML(SourceTypeHTTPRequest):
+    @classmethod
+    def fromstring(cls, content):
+        if isinstance(content, str):
+            return etree.fromstring(content.encode("utf-8"), cls.get_parser("utf-8"))
+        return etree.fromstring(content, cls.get_parser())
 
     @classmethod
-    def parse_from_url(cls, text):
-        return etree.fromstring(text.encode("utf-8"), etree.HTMLParser(encoding="utf-8"))
+    def compile_xpath(cls, path):
+        xpaths = cls.local.__dict__.setdefault("xpaths", {})
+        if (xpath := xpaths.get(path)) is None:
+            # Plain strings, which unlike "smart" strings do not keep the whole tree alive.
+            xpath = xpaths[path] = etree.XPath(path, smart_strings=False)
+        return xpath
 
     @classmethod
     def get_xpath(cls, node, path):
-        return node.xpath(path)
+        return cls.compile_xpath(path)(node)
+
+
+class XMLStream():
+    # An XML document parsed while it is being downloaded. Iterate over it to get the items one at a time.
+    # Each item is freed (along with everything before it) once the next one is asked for.
+    # The download stops with an error after `max_bytes` (decompressed), keeping the items before.
+
+    def __init__(self, response, tag, ancestors=None, max_bytes=None):
+        self.response = response
+        self.tag = tag
+        # Tags from the root (excluded) down to the parent of the items. `None` for any.
+        self.ancestors = ancestors
+        self.max_bytes = max_bytes
+        self.root = None
+        self.error = None
+
+    def __iter__(self):
+        # As `SourceTypeLXML.get_content`, a charset in the headers overrides the one declared in the document.
+        encoding = self.response.encoding if "charset" in self.response.headers.get("Content-Type", "").lower() else None
+        parser = etree.XMLPullParser(events=("end",), tag=self.tag, encoding=encoding)
+        size = 0
+        try:
+            for chunk in self.response.iter_content(CHUNK_SIZE):
+                if self.max_bytes is not None and (size := size + len(chunk)) > self.max_bytes:
+                    self.error = f"Larger than {self.max_bytes} bytes."
+                    return
+                parser.feed(chunk)
+                yield from self.read_events(parser)
+            parser.close()
+            yield from self.read_events(parser)
+        except etree.XMLSyntaxError as e:
+            self.error = e
+        finally:
+            self.close()
+
+    def read_events(self, parser):
+        for _, element in parser.read_events():
+            if self.root is None:
+                self.root = element.getroottree().getroot()
+            if self.ancestors is not None and [node.tag for node in element.iterancestors()][-2::-1] != self.ancestors:
+                continue
+            yield element
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    def close(self):
+        self.response.close()
+
+
+class SourceTypeXML(SourceTypeLXML):
+    parser_class = etree.XMLParser
+
+    @classmethod
+    def parse_from_url(cls, content):
+        try:
+            return cls.fromstring(content)
+        except etree.XMLSyntaxError:
+            return
+
+    @classmethod
+    def parse_stream(cls, response, item_xpath, max_bytes=None):
+        # Only `.//tag` or paths of plain child steps like `./channel/item` can be matched while streaming.
+        if (match := re.fullmatch(r"\.//([\w\-]+)", item_xpath)) is not None:
+            return XMLStream(response, match[1], max_bytes=max_bytes)
+        if re.fullmatch(r"(\./)?[\w\-]+(/[\w\-]+)*", item_xpath) is not None:
+            *ancestors, tag = item_xpath.removeprefix("./").split("/")
+            return XMLStream(response, tag, ancestors, max_bytes)
+
+
+class SourceTypeHTML(SourceTypeLXML):
+    parser_class = etree.HTMLParser
+
+    @classmethod
+    def parse_from_url(cls, content):
+        return cls.fromstring(content)
 
 
 class SourceTypeJSON(SourceTypeHTTPRequest):
 
     @classmethod
-    def parse_from_url(cls, text):
+    def get_content(cls, response, body):
+        # `json.loads` detects the encoding (UTF-8, -16 or -32) by itself.
+        return body
+
+    @classmethod
+    def parse_from_url(cls, content):
         try:
-            doc = json.loads(text)
+            doc = json.loads(content)
             if isinstance(doc, dict):
                 return doc
         except json.JSONDecodeError:
@@ -53,4 +173,4 @@ class SourceTypeJSON(SourceTypeHTTPRequest):
 
     @classmethod
     def get_xpath(cls, node, path):
-        return eval(path, {"node": node})
+        return eval_expression(path, {}, {"node": node})
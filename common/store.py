@@ -0,0 +1,47 @@
+# coding: utf-8
+
+import json
+from const import r
+from common import scheduler
+
+# Everything a run of `scripts/fetch.py` reads from Redis is fetched in two round-trips: `prefetch` for the state of the run,
+# then `prefetch_item_ids` for the feeds found due in it. Everything it writes is queued on one transaction at the end of the run.
+
+
+def get_chats():
+    return {chat_id: json.loads(chat_info) for chat_id, chat_info in r.hgetall("chats").items()}
+
+
+def prefetch():
+    with r.pipeline(transaction=False) as pipe:
+        pipe.hgetall("http_cache")
+        pipe.hgetall("chats")
+        scheduler.queue_schedule(pipe)
+        http_cache, chats, *results = pipe.execute()
+    return {
+        "http_cache": {key: json.loads(value) for key, value in http_cache.items()},
+        "chats": {chat_id: json.loads(chat_info) for chat_id, chat_info in chats.items()},
+        "schedule": scheduler.parse_schedule(results),
+    }
+
+
+def prefetch_item_ids(feed_names):
+    # The ids of the items sent from each feed are stored in a sorted set scored by the last time the item was seen in the feed.
+    feed_names = list(feed_names)
+    with r.pipeline(transaction=False) as pipe:
+        for feed_name in feed_names:
+            pipe.zrange(f"feed_item_ids:{feed_name}", 0, -1)
+        # Ids stored by previous versions, joined by ":" in a hash.
+        pipe.hmget("feed_item_ids", feed_names or [""])
+        *item_ids, legacy_item_ids = pipe.execute()
+    return {
+        "item_ids": {
+            feed_name: set(ids) or set((legacy_ids or "").split(":")) - {""}
+            for feed_name, ids, legacy_ids in zip(feed_names, item_ids, legacy_item_ids)
+        },
+        # Only the ids new in the last fetch of a feed were stored by previous versions, which stopped at the first id sent before.
+        "legacy_feeds": set(
+            feed_name for feed_name, ids, legacy_ids in zip(feed_names, item_ids, legacy_item_ids)
+            if not ids and legacy_ids
+        ),
+    }
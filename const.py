@@ -2,9 +2,26 @@
 
 import os
 import redis
-import yaml
+from common.config import get_config, HTTP_CONFIG_FIELDS
 
 INTERVAL = 60
+# How often the fetch task runs (minutes)
+TASK_INTERVAL = 60
+# A feed with nothing new is fetched less often, up to `MAX_BACKOFF` times its interval
+MAX_BACKOFF = 4
+# Max number of feeds to fetch at the same time, in total and from the same host
+MAX_WORKERS = 8
+MAX_WORKERS_PER_HOST = 2
+# Feeds fetched ahead of the one being processed, as a multiple of `max_workers`. Bounds the documents held in memory
+READ_AHEAD = 2
+# A host is skipped for the rest of a run once this many of its feeds have failed in the run
+MAX_FAILURES_PER_HOST = 2
+# A feed which fails `threshold` times in a row is not fetched for `cooldown` minutes, doubled with each further failure up to `max_cooldown`
+CIRCUIT_BREAKER = {
+    "threshold": 3,
+    "cooldown": 60,
+    "max_cooldown": 24 * 60,
+}
 ITEM_XPATH = "./channel/item"
 FIELDS_XPATH = {
     "link": "./link/text()",
@@ -12,13 +29,49 @@ FIELDS_XPATH = {
     "description": "./description/text()",
     "pub_date": "./pubDate/text()",
 }
+# Max size of a feed (in bytes, decompressed), beyond which its download is given up
+MAX_BYTES = 10 * 1024 * 1024
+# Size of the chunks feeds are downloaded in
+CHUNK_SIZE = 64 * 1024
+# How long the ids of sent items are remembered: the latest `num` ids, not older than `age` minutes
+ITEM_ID_RETENTION = {
+    "num": 1000,
+    "age": 30 * 24 * 60,
+}
+# Telegram's limits on sending messages, in total and to the same chat
+MESSAGES_PER_SECOND = 30
+MESSAGES_PER_MINUTE_PER_CHAT = 20
+# Max number of chats to send messages to at the same time
+MAX_SEND_WORKERS = 32
+# A process sending messages to a chat is considered dead if it does not send anything in this long (seconds)
+OUTBOX_LOCK_TIMEOUT = 600
+# Number of run summaries kept in Redis for `/metrics`
+RUN_SUMMARIES = 100
+# Max number of reports of shards waiting for the reports of the other shards. See `scripts/fetch.py --shard`.
+SHARD_REPORTS = 100
+# https://core.telegram.org/bots/api#sendmessage and https://core.telegram.org/bots/api#sendmediagroup
+MAX_MESSAGE_LENGTH = 4096
+MAX_MEDIA_GROUP_SIZE = 10
 MESSAGE_TYPE = "Message"
 MESSAGE_FORMAT = "{title}\n{description}\n{pub_date}\n{link}"
 WEBHOOK_TOKEN = os.environ.get("WEBHOOK_TOKEN", "")
+# `/metrics/<METRICS_TOKEN>` is served only if set, as it shows the chat ids and the feeds
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+# Can be pointed to a local Bot API server, or the stand-in of `scripts/benchmark.py`
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
 r = redis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379"), decode_responses=True)
-CONFIG = yaml.load(r.get("config") or "", yaml.Loader) or {}
+# Resolved by `/setConfig`. See `common.config`.
+CONFIG = get_config(r)
 bot_token = CONFIG.get("bot_token", os.environ.get("BOT_TOKEN"))
 admin_chat_id = CONFIG.get("admin_chat_id", os.environ.get("ADMIN_CHAT_ID"))
+# Connection pools, timeout ((connect, read) in seconds) and retries of the HTTP sessions for feeds and Telegram. Unknown keys are refused by `/setConfig` (and ignored in configs saved before)
+HTTP_CONFIG = {
+    "pool_connections": 64,
+    "pool_maxsize": 32,
+    "timeout": [5, 30],
+    "retries": 2,
+    "backoff_factor": 0.5,
+} | {key: value for key, value in CONFIG.get("http_config", {}).items() if key in HTTP_CONFIG_FIELDS}
 
 try:
     from my.funcs import FUNCS
@@ -0,0 +1,254 @@
+# coding: utf-8
+
+# Runs `scripts/fetch.py` end to end without touching the network: the feeds are served by a local HTTP server, which
+# also stands in for the Telegram Bot API, enforcing its rate limits with 429 and `retry_after`.
+# Redis is fakeredis if installed, or the scratch Redis given by `--redis-url`, which is FLUSHED.
+#   python scripts/benchmark.py --feeds 100 --items 20 --chats 10 --runs 3 --save benchmark.json
+#   python scripts/benchmark.py ... --baseline benchmark.json  # Exits with 1 if slower than the baseline.
+
+import os
+import sys
+import argparse
+import collections
+import email.utils
+import json
+import math
+import resource
+import threading
+import time
+import urllib.parse
+import yaml
+from loguru import logger
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_feed(feed_type, idx, generation, num_items, item_size):
+    # The items of a generation are the same as the previous one, but `num_items // 2` of them are new.
+    first = generation * (num_items // 2)
+    items = [
+        {
+            "title": f"Item {k} of feed {idx}",
+            "link": f"https://example.com/{idx}/{k}",
+            "description": "x" * item_size,
+            "pub_date": email.utils.formatdate(1_600_000_000 + k * 60, usegmt=True),
+        }
+        for k in range(first + num_items - 1, first - 1, -1)
+    ]
+    if feed_type == "json":
+        return json.dumps({"items": items}).encode("utf-8"), "application/json"
+    if feed_type == "html":
+        return ("<html><body>" + "".join(
+            f"<div class='item'><a href='{item['link']}'>{item['title']}</a><p>{item['description']}</p><time>{item['pub_date']}</time></div>"
+            for item in items
+        ) + "</body></html>").encode("utf-8"), "text/html; charset=utf-8"
+    return ('<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel><title>Feed</title>' + "".join(
+        f"<item><title>{item['title']}</title><link>{item['link']}</link><description>{item['description']}</description><pubDate>{item['pub_date']}</pubDate></item>"
+        for item in items
+    ) + "</channel></rss>").encode("utf-8"), "application/rss+xml"
+
+
+def make_feed_config(feed_type, idx, base_url):
+    config = {"name": f"{feed_type}{idx}", "url": f"{base_url}/{feed_type}/{idx}"}
+    if feed_type == "json":
+        config |= {
+            "source_type": "JSON",
+            "item_xpath": "node['items']",
+            "xpath": {key: f"[node['{key}']]" for key in ["title", "link", "description", "pub_date"]},
+        }
+    elif feed_type == "html":
+        config |= {
+            "source_type": "HTML",
+            "item_xpath": ".//div[@class='item']",
+            "xpath": {"title": "./a/text()", "link": "./a/@href", "description": "./p/text()", "pub_date": "./time/text()"},
+        }
+    return config
+
+
+class FakeTelegram():
+    # Allows `rate` messages in any second, and `chat_rate` messages to a chat in any minute, both `speedup` times faster.
+
+    def __init__(self, rate, chat_rate, speedup=1):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.speedup = speedup
+        self.sent = collections.deque()
+        self.chat_sent = collections.defaultdict(collections.deque)
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def post(self, chat_id, num_messages):
+        # Returns `retry_after`, or None if the messages are sent.
+        with self.lock:
+            now = time.monotonic()
+            retry_after = 0
+            for sent, limit, window in [
+                (self.sent, self.rate, 1 / self.speedup),
+                (self.chat_sent[chat_id], self.chat_rate, 60 / self.speedup),
+            ]:
+                while sent and sent[0] <= now - window:
+                    sent.popleft()
+                if len(sent) + num_messages > limit:
+                    retry_after = max(retry_after, sent[0] + window - now)
+            if retry_after:
+                self.counts["429"] += 1
+                return max(1, math.ceil(retry_after))
+            for sent in [self.sent, self.chat_sent[chat_id]]:
+                sent.extend([now] * num_messages)
+            self.counts["messages"] += num_messages
+            self.counts["requests"] += 1
+
+
+def make_handler(feeds, state):
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive, as the feeds and Telegram.
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, data, content_type):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            _, feed_type, idx = self.path.split("/")
+            self.reply(200, *make_feed(feed_type, int(idx), state["generation"], feeds["items"], feeds["item_size"]))
+
+        def do_POST(self):
+            args = urllib.parse.parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+            num_messages = len(json.loads(args["media"][0])) if self.path.endswith("/sendMediaGroup") else 1
+            if (retry_after := state["telegram"].post(args["chat_id"][0], num_messages)) is None:
+                self.reply(200, json.dumps({"ok": True, "result": {}}).encode("utf-8"), "application/json")
+            else:
+                self.reply(429, json.dumps({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {retry_after}",
+                    "parameters": {"retry_after": retry_after},
+                }).encode("utf-8"), "application/json")
+
+    return Handler
+
+
+def make_config(args, base_url):
+    feeds = [
+        make_feed_config(feed_type, idx, base_url)
+        for idx in range(args.feeds)
+        for feed_type in [args.types[idx % len(args.types)]]
+    ]
+    # The feeds are split among the groups, and all chats of a group get the same messages.
+    groups = [
+        {"name": f"group{idx}", "feeds": [feed["name"] for feed in feeds[idx::args.groups]], "sort_key": "pub_date"}
+        for idx in range(args.groups)
+    ]
+    return {
+        "feeds": feeds,
+        "rssgroups": groups,
+        "chats": {f"chat{idx}": f"group{idx % args.groups}" for idx in range(args.chats)},
+        "fetch_config": {"max_workers_per_host": args.feeds},
+    }
+
+
+def check_baseline(results, baseline, tolerance):
+    # Returns the regressions from `baseline`.
+    regressions = []
+    for key in ["feeds_per_second", "messages_per_second"]:
+        if results[key] < baseline[key] * (1 - tolerance):
+            regressions.append(f"{key}: {results[key]:.1f} < {baseline[key]:.1f}")
+    if results["peak_rss_kib"] > baseline["peak_rss_kib"] * (1 + tolerance):
+        regressions.append(f"peak_rss_kib: {results['peak_rss_kib']} > {baseline['peak_rss_kib']}")
+    return regressions
+
+
+def main(args):
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+    state = {"generation": 0, "telegram": None}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler({"items": args.items, "item_size": args.item_size}, state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    # Read by `const.py` when imported.
+    os.environ["TELEGRAM_API_URL"] = base_url
+    os.environ["BOT_TOKEN"] = "benchmark"
+    os.environ.pop("ADMIN_CHAT_ID", None)
+    if args.redis_url:
+        os.environ["REDIS_URL"] = args.redis_url
+    else:
+        import fakeredis
+        import redis
+        fake_server = fakeredis.FakeServer()
+        redis.from_url = lambda url, **kwargs: fakeredis.FakeRedis(server=fake_server, **kwargs)
+    from const import r, MESSAGES_PER_SECOND, MESSAGES_PER_MINUTE_PER_CHAT
+    r.flushdb()
+    from common import send_message
+    from common.config import save_config, get_config
+    from common.rate_limiter import RateLimiter
+    from scripts import fetch
+    state["telegram"] = telegram = FakeTelegram(MESSAGES_PER_SECOND, MESSAGES_PER_MINUTE_PER_CHAT, args.speedup)
+    send_message.rate_limiter = RateLimiter(MESSAGES_PER_SECOND * args.speedup, MESSAGES_PER_MINUTE_PER_CHAT * args.speedup / 60)
+    save_config(r, yaml.dump(make_config(args, base_url)))
+    config = get_config(r)
+
+    totals = collections.Counter()
+    for run in range(args.runs):
+        state["generation"] = run
+        # All the feeds are due.
+        r.delete("feed_schedule", "last_fetch_time")
+        started_at = time.perf_counter()
+        fetch.main(config, publish_report=False)
+        seconds = time.perf_counter() - started_at
+        stats = fetch.report.get("stats", {})
+        stages = {stage: values["seconds"] for stage, values in stats.get("stages", {}).items()}
+        requests = sum(values["requests"] for values in stats.get("chats", {}).values())
+        totals.update(stages)
+        totals.update(seconds=seconds, feeds=len(stats.get("feeds", {})), requests=requests, items=sum(item["num"] for item in fetch.report["num_items"]))
+        print(
+            f"Run {run}: {seconds:.2f}s, {len(stats.get('feeds', {}))} feeds, {requests} requests to Telegram. "
+            + ", ".join(f"{stage} {value:.2f}s" for stage, value in stages.items())
+        )
+
+    results = {
+        "feeds_per_second": totals["feeds"] / max(totals["load"] + totals["fetch"], 1e-9),
+        "messages_per_second": telegram.counts["messages"] / max(totals["send"], 1e-9),
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "stages": {stage: totals[stage] for stage in ["load", "fetch", "group", "save", "send"]},
+        "new_items": totals["items"],
+        "messages": telegram.counts["messages"],
+        "responses_429": telegram.counts["429"],
+        "seconds": totals["seconds"],
+    }
+    print(yaml.dump(results, sort_keys=False), end="")
+    server.shutdown()
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if regressions := check_baseline(results, json.load(f), args.tolerance):
+                print("Regressions:\n" + "\n".join(f"  {line}" for line in regressions))
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark `scripts/fetch.py` against local feeds and a stand-in of the Telegram Bot API.")
+    parser.add_argument("--feeds", type=int, default=50, help="Number of feeds.")
+    parser.add_argument("--items", type=int, default=20, help="Number of items in each feed, half of which are new in each run.")
+    parser.add_argument("--item-size", type=int, default=500, help="Size of the description of each item.")
+    parser.add_argument("--types", type=lambda value: value.split(","), default=["rss", "html", "json"], help="Comma separated types of the feeds, out of rss, html and json.")
+    parser.add_argument("--groups", type=int, default=5, help="Number of groups the feeds are split among.")
+    parser.add_argument("--chats", type=int, default=10, help="Number of chats, each subscribed to a group.")
+    parser.add_argument("--runs", type=int, default=3, help="Number of runs.")
+    parser.add_argument("--speedup", type=float, default=60, help="Make the rate limits of Telegram this many times faster, on both sides.")
+    parser.add_argument("--redis-url", help="A scratch Redis to use instead of fakeredis. It is flushed!")
+    parser.add_argument("--log-level", default="WARNING", help="Level of the logs of the bot, e.g. DEBUG.")
+    parser.add_argument("--save", metavar="FILE", help="Save the results as JSON.")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare with the results saved by --save.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression from the baseline, as a fraction.")
+    sys.exit(main(parser.parse_args()))
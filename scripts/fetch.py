@@ -1,23 +1,42 @@
 # coding: utf-8
 
 import os
+import argparse
+import contextlib
+import copy
 import datetime
+import functools
 import hashlib
-import math
-import random
+import heapq
+import json
+import multiprocessing
+import signal
+import threading
+import time
+import urllib.parse
 import yaml
-from collections import defaultdict, Counter
+from collections import defaultdict, deque, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import zip_longest
 from loguru import logger
-from const import INTERVAL, ITEM_XPATH, FIELDS_XPATH, FUNCS, r, source_type_class_map, CONFIG, admin_chat_id, bot_token
-from common.merge_dict import merge_dict
-from common.get_chat_info import get_chat_info
-from common.send_message import send_message, _send_message
+from const import INTERVAL, TASK_INTERVAL, MAX_BACKOFF, ITEM_XPATH, FIELDS_XPATH, ITEM_ID_RETENTION, FUNCS, MAX_WORKERS, MAX_WORKERS_PER_HOST, READ_AHEAD, MAX_FAILURES_PER_HOST, CIRCUIT_BREAKER, MAX_BYTES, CHUNK_SIZE, MAX_SEND_WORKERS, SHARD_REPORTS, r, source_type_class_map, CONFIG, admin_chat_id, bot_token
+from common.expression import eval_expression
+from common.source_type import XMLStream
+from common.extract import ExtractedFeed, extract_items, get_ttl
+from common.item import Item, GroupItem
+from common.send_message import render_messages, deliver_message, _send_message, split_message
+from common import metrics, outbox, profiling, scheduler, store
+from common.archive import Archive
+from common.config import get_config
+from common.session import feed_session
 
 
 report = {}
 
 
-def get_report_string():
+def get_report_string(report=report, chats_info=None):
+    if chats_info is None:
+        chats_info = store.get_chats()
     report_string = []
     report_string.append(f"Run at {report['start_at']}.")
     report_string.append("Next fetch time:")
@@ -38,123 +57,339 @@ def get_report_string():
         report_string.append(f"Num of errors when evaluating feed item id: {report['get_feed_item_id_errors']}.")
     if len(report["get_group_item_id_errors"]):
         report_string.append(f"Num of errors when evaluating group item id: {report['get_group_item_id_errors']}.")
+    if len(report.get("skipped", [])):
+        report_string.append(f"{len(report['skipped'])} feeds skipped, for other feeds from the same hosts have failed: {', '.join(report['skipped'])}")
+    if len(report.get("open_circuits", [])):
+        report_string.append(f"{len(report['open_circuits'])} feeds paused after failing in a row (failures, next try):")
+        report_string.extend([
+            f"  {item['name']}: {item['failures']}, {item['time'].strftime('%Y-%m-%d %H:%M:%S%z')}"
+            for item in sorted(report["open_circuits"], key=lambda item: item["time"])
+        ])
+    if len(report.get("not_modified", [])):
+        report_string.append(f"{len(report['not_modified'])} feeds not modified since the last fetch (cache hits): {', '.join(report['not_modified'])}")
     report_string.append(f"Fetching results:")
     report_string.extend([
-        f"  {item['num']} new items from {item['name']}. {'No overlapping from previous fetch.' if item['break'] != 1 else ''}"
+        f"  {item['num']} new items from {item['name']}. {'No overlapping from previous fetch.' if not item['overlap'] else ''}"
         for item in report["num_items"]
     ])
     report_string.append(f"Number of messages to send:")
-    report_string.extend([f"  {item['num']} messages of group {item['chat']} to ({get_chat_info(item['chat_id'])})" for item in report["num_messages"]])
+    report_string.extend([f"  {item['num']} messages of group {item['chat']} to ({chats_info.get(item['chat_id'], {})})" for item in report["num_messages"]])
     if len(report.get("send_message_errors", [])):
         report_string.append(f"Num of errors when sending messages:")
-        report_string.extend([f'{value}: ({get_chat_info(chat_id)})' for chat_id, value in report['send_message_errors'].items()])
-    lines = []
-    cur_line = ""
+        report_string.extend([f'{value}: ({chats_info.get(chat_id, {})})' for chat_id, value in report['send_message_errors'].items()])
+    if stats := report.get("stats"):
+        report_string.append("Time spent:")
+        report_string.append("  " + ", ".join(f"{stage} {values['seconds']:.2f}s" for stage, values in stats.get("stages", {}).items()))
+        if stats.get("feeds"):
+            report_string.append("Feeds, slowest first:")
+        report_string.extend([
+            f"  {name}: {values['fetch_seconds']:.2f}s fetching (parsing {values['parse_seconds']:.2f}s), {values['extract_seconds']:.2f}s extracting, {values['bytes'] / 1024:.1f} KiB downloaded, {values['items']} items"
+            + (f", {values['extract_process_alloc_bytes'] / 1024:.1f} KiB peak allocated by the process while extracting" if "extract_process_alloc_bytes" in values else "")
+            for name, values in sorted(stats.get("feeds", {}).items(), key=lambda item: -item[1]["fetch_seconds"] - item[1]["extract_seconds"])
+        ])
+        if stats.get("chats"):
+            report_string.append("Chats, slowest first:")
+        report_string.extend([
+            f"  {values['requests']} requests in {values['send_seconds']:.2f}s, {values['rate_limit_seconds']:.2f}s rate limited: ({chats_info.get(chat_id, {})})"
+            for chat_id, values in sorted(stats.get("chats", {}).items(), key=lambda item: -item[1]["send_seconds"] - item[1]["rate_limit_seconds"])
+        ])
     # Split report into several messages each shorter than 4096 characters
-    # https://core.telegram.org/bots/api#sendmessage
-    for line in report_string:
-        if len(cur_line + "\n" + line) <= 4000:
-            cur_line += "\n" + line
-        else:
-            lines.append(cur_line)
-            cur_line = line
-    if cur_line:
-        lines.append(cur_line)
+    lines = split_message(report_string, 4000)
     return [f"Page {idx+1}/{len(lines)}\n{line}" for idx, line in enumerate(lines)]
 
 
-# Interval of the task (minutes)
-TASK_INTERVAL = 60
-
-
-def filter_feeds_by_interval(intervals):
-    current_ts = datetime.datetime.now().timestamp()
-    last_fetch_time = r.hgetall("last_fetch_time")
-
-    report["next_fetch_time"] = [
-        {
-            "name": feed_name,
-            # Fetch the feed with a very small prob even if it's not time. Two reasons for this:
-            # 1. If you, for example, have 10 feeds all with intervals of 2 hours, this will slowly slowly spread the tasks evenly in every hour, rather than doing everything in one hour and idling in the other.
-            # 2. The `last_fetch_time` will be several minutes later than the script starts, if you have a feed with an interval of 2 hours, it will be very likely retrieved only every 3 hours, if we do nothing here.
-            "fetch": 1 / (1 + math.exp(- ((current_ts - float(last_fetch_time.get(feed_name) or 0) - interval * 60) / (60 * TASK_INTERVAL) * 15))) > random.random() / 2,
-            "time": (datetime.datetime.fromtimestamp(float(last_fetch_time.get(feed_name, '0'))) + datetime.timedelta(minutes=interval)).astimezone(datetime.timezone.utc),
-        }
-        for feed_name, interval in intervals.items()
-    ]
-
-    return set(
-        item["name"] for item in report["next_fetch_time"] if item["fetch"]
-    )
-
-
-def update_last_fetch_time(keys):
+def update_last_fetch_time(keys, pipe):
     last_fetch_time = datetime.datetime.now().timestamp()
-    return len(keys) == 0 or r.hset("last_fetch_time", mapping={
-        key: last_fetch_time
-        for key in keys
-    }) == len(keys)
+    if len(keys):
+        pipe.hset("last_fetch_time", mapping={
+            key: last_fetch_time
+            for key in keys
+        })
 
 
-def parse_from_url(method, url, source_type, kwargs):
+# Returned instead of a document if the feed has not changed since the last fetch.
+NOT_MODIFIED = object()
+# Returned instead of a document if the feed is not fetched because its host keeps failing.
+SKIPPED = object()
+
+
+def get_response(scls, method, url, kwargs, http_cache):
+    # Returns the response (or `NOT_MODIFIED`) and the cache entry to save for the next fetch.
+    if http_cache is not None and method.upper() == "GET":
+        # https://developer.mozilla.org/en-US/docs/Web/HTTP/Conditional_requests
+        kwargs = kwargs | {"headers": kwargs.get("headers", {}) | {
+            header: http_cache[key]
+            for key, header in [("etag", "If-None-Match"), ("last_modified", "If-Modified-Since")]
+            if http_cache.get(key)
+        }}
+    if (response := scls.get_response(method, url, kwargs)) is None:
+        return None, None
+    if response.status_code == 304 and http_cache is not None:
+        # Streamed, so the connection is back to the pool only once closed.
+        response.close()
+        return NOT_MODIFIED, http_cache
+    return response, {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+def read_body(response, max_bytes):
+    # Downloads the body (decompressed) in chunks, so that a feed larger than `max_bytes` is given up without reading all of it.
+    # Returns the body, or None if it is given up.
+    chunks = []
+    size = 0
+    with response:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            if max_bytes is not None and (size := size + len(chunk)) > max_bytes:
+                return None
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def get_text(scls, response, body, http_cache, new_http_cache):
+    # Returns the content for `scls.parse_from_url` (or `NOT_MODIFIED`), and adds its hash to the cache entry.
+    text = scls.get_content(response, body)
+    new_http_cache["hash"] = hashlib.sha1(text.encode("utf-8") if isinstance(text, str) else text).hexdigest()
+    if http_cache is not None and http_cache.get("hash") == new_http_cache["hash"]:
+        return NOT_MODIFIED
+    return text
+
+
+def update_item_ids(item_ids, feeds, pipe):
+    # `item_ids` are the ids of all the items in this fetch of each feed. Their scores are refreshed, so that items still in a feed are never dropped.
+    # Ids which have not been seen for `id_retention.age` minutes, or beyond the latest `id_retention.num` ids, are dropped.
+    now = datetime.datetime.now().timestamp()
+    for feed_name, ids in item_ids.items():
+        retention = ITEM_ID_RETENTION | feeds[feed_name].get("id_retention", {})
+        pipe.zadd(key := f"feed_item_ids:{feed_name}", {item_id: now for item_id in ids})
+        pipe.zremrangebyscore(key, "-inf", now - retention["age"] * 60)
+        pipe.zremrangebyrank(key, 0, - max(retention["num"], len(ids)) - 1)
+    pipe.hdel("feed_item_ids", *item_ids.keys())
+
+
+def parse_from_url(method, url, source_type, kwargs, http_cache=None, item_xpath=None, stats=None, parse=None, max_bytes=None):
+    # Returns the document (or `NOT_MODIFIED`) and the cache entry to save for the next fetch.
+    # The body is downloaded in chunks, and given up after `max_bytes`.
+    # With `item_xpath`, the document is parsed as it is downloaded if the source type supports it. See `XMLStream`.
+    # `parse(content)` replaces `parse_from_url` of the source type, e.g. to parse in another process.
+    # The bytes downloaded (as sent, before decompression) and the time to parse are added to `stats`.
+    stats = Counter() if stats is None else stats
     if (scls := source_type_class_map.get(source_type)) is None:
         logger.error(f"Unsupported source type: {source_type}.")
-    elif (text := scls.get_text(method, url, kwargs)) is None or (doc := scls.parse_from_url(text)) is None:
-        logger.error(f"Failed to parse from {url=}. {source_type=}")
+        return None, None
+    if not hasattr(scls, "get_response"):
+        # Custom source types may only implement `get_text`, whose size is all that is known of the download.
+        text, new_http_cache = scls.get_text(method, url, kwargs), None
+        stats["bytes"] += len(text or "")
     else:
-        return doc
+        if http_cache is not None and http_cache.get("url") != url:
+            http_cache = None
+        stream = item_xpath is not None and hasattr(scls, "parse_stream")
+        response, new_http_cache = get_response(scls, method, url, kwargs | {"stream": True}, http_cache)
+        if response is NOT_MODIFIED:
+            return NOT_MODIFIED, new_http_cache
+        if response is None:
+            text = None
+        elif stream and (doc := scls.parse_stream(response, item_xpath, max_bytes)) is not None:
+            return doc, new_http_cache
+        elif (body := read_body(response, max_bytes)) is None:
+            logger.error(f"Gave up {url=}, which is larger than {max_bytes} bytes.")
+            return None, None
+        else:
+            stats["bytes"] += response.raw.tell()
+            text = get_text(scls, response, body, http_cache, new_http_cache)
+            if text is NOT_MODIFIED:
+                return NOT_MODIFIED, new_http_cache
+    started_at = time.perf_counter()
+    doc = None if text is None else (parse or scls.parse_from_url)(text)
+    stats["parse_seconds"] += time.perf_counter() - started_at
+    if doc is None:
+        logger.error(f"Failed to parse from {url=}. {source_type=}")
+        return None, None
+    return doc, new_http_cache
 
 
 def get_xpath(node, path, source_type):
     return source_type_class_map[source_type].get_xpath(node, path)
 
 
-def get_feed_items(config):
-    if "parse_from_url_errors" not in report:
-        report["parse_from_url_errors"] = []
-    if (doc := parse_from_url(
+def get_fields_xpath(config):
+    # Can be deliberately set to `None` to skip default fields.
+    return [(key, xpath) for key, xpath in (FIELDS_XPATH | config.get("xpath", {})).items() if xpath is not None]
+
+
+process_pools = {}
+
+
+def get_process_pool(max_workers):
+    # Kept for the life of the process, e.g. across the runs of a daemon.
+    if (pool := process_pools.get(max_workers)) is None:
+        # Not forked from this process, which has threads running.
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        pool = process_pools[max_workers] = ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context(method))
+    return pool
+
+
+def parse_in_process(pool, config, content):
+    # Parses the content and extracts the fields of the items in `pool`. See `common.extract`.
+    source_type = config.get("source_type", "XML")
+    try:
+        return pool.submit(extract_items, source_type, content, config.get("item_xpath", ITEM_XPATH), get_fields_xpath(config)).result()
+    except Exception as e:
+        # E.g. fields which are nodes rather than strings, which cannot be sent back.
+        logger.warning(f"Failed to parse feed {config['name']} in another process, parsing it here. Error `{e}`.")
+        return source_type_class_map[source_type].parse_from_url(content)
+
+
+def fetch_feed(config, http_cache=None, process_pool=None):
+    stats = Counter()
+    started_at = time.perf_counter()
+    ret = parse_from_url(
         config.get("method", "GET"),
         config["url"],
-        (source_type := config.get("source_type", "XML")),
-        config.get("request_args", {})
-    )) is None:
+        config.get("source_type", "XML"),
+        config.get("request_args", {}),
+        http_cache,
+        config.get("item_xpath", ITEM_XPATH) if config.get("stream") else None,
+        stats,
+        functools.partial(parse_in_process, process_pool, config) if process_pool is not None and config.get("parse_in_process") and not config.get("stream") else None,
+        config.get("max_bytes", MAX_BYTES)
+    )
+    metrics.add(report, "feeds", config["name"], fetch_seconds=time.perf_counter() - started_at, **stats)
+    return ret
+
+
+def fetch_feeds(feeds, fetch_config, http_cache):
+    # Download and parse the feeds in a thread pool, at most `max_workers` at a time and `max_workers_per_host` for the same host.
+    # The documents are yielded in the order they are submitted, round-robin over the hosts, so that a busy host does not
+    # keep all the workers waiting for its semaphore.
+    hosts = defaultdict(list)
+    for feed in feeds:
+        hosts[urllib.parse.urlsplit(feed["url"]).netloc].append(feed)
+    host_semaphores = {
+        host: threading.BoundedSemaphore(fetch_config.get("max_workers_per_host", MAX_WORKERS_PER_HOST))
+        for host in hosts
+    }
+
+    # CPU-heavy feeds can be parsed in other processes, out of the GIL.
+    process_pool = None
+    if any(feed.get("parse_in_process") for feed in feeds) and (processes := fetch_config.get("parse_processes", os.cpu_count())):
+        process_pool = get_process_pool(processes)
+
+    # A host failing again and again (e.g. timing out) is given up for the rest of the run, rather than holding up the run.
+    host_failures = Counter()
+    host_failures_lock = threading.Lock()
+
+    def _fetch_feed(feed):
+        with host_semaphores[host := urllib.parse.urlsplit(feed["url"]).netloc]:
+            if host_failures[host] >= fetch_config.get("max_failures_per_host", MAX_FAILURES_PER_HOST):
+                return SKIPPED, None
+            if (ret := fetch_feed(feed, http_cache.get(feed["name"]), process_pool))[0] is None:
+                with host_failures_lock:
+                    host_failures[host] += 1
+            return ret
+
+    feeds = iter([feed for feeds_of_round in zip_longest(*hosts.values()) for feed in feeds_of_round if feed is not None])
+    max_workers = fetch_config.get("max_workers", MAX_WORKERS)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Only a few feeds are submitted ahead of the one being processed, so that a slow feed does not keep the documents
+        # of all the feeds after it in memory.
+        futures = deque()
+        try:
+            while True:
+                while len(futures) < READ_AHEAD * max_workers and (feed := next(feeds, None)) is not None:
+                    futures.append((feed, executor.submit(_fetch_feed, feed)))
+                if not futures:
+                    break
+                feed, future = futures.popleft()
+                yield feed, *future.result()
+        finally:
+            # Closed early, e.g. on SIGTERM: only wait for the downloads already started.
+            executor.shutdown(cancel_futures=True)
+
+
+def check_ttl(ttl, config):
+    # The feed will not be fetched more often than its `<ttl>`. See `common.scheduler`.
+    # None is recorded as well, to forget the ttl of a feed which no longer has one.
+    report.setdefault("ttl", {})[config["name"]] = ttl
+    if ttl is not None and ttl > (interval := config.get("interval", INTERVAL)):
+        logger.info(f"The recommended interval for feed {config['name']} is {ttl} minutes, while the interval you set is {interval} minutes. Will fetch every {ttl} minutes.")
+
+
+def get_feed_items(config, doc):
+    source_type = config.get("source_type", "XML")
+    if "parse_from_url_errors" not in report:
+        report["parse_from_url_errors"] = []
+    if doc is None:
         report["parse_from_url_errors"].append({
             "name": config["name"],
         })
         return
 
-    if source_type == "XML" and len(ttl_node := doc.xpath("/rss/channel/ttl/text()")) == 1 and ttl_node[0].isdigit() and (ttl := int(ttl_node[0])) > (interval := config.get("interval", INTERVAL)):
-        logger.warning(f"The recommended interval for this feed is {ttl} minutes, while the interval you set is {interval} minutes.")
+    stream = isinstance(doc, XMLStream)
+    if extracted := isinstance(doc, ExtractedFeed):
+        check_ttl(doc.ttl, config)
+        items = doc.items
+    elif stream:
+        items = doc
+    else:
+        check_ttl(get_ttl(doc, source_type), config)
+        items = get_xpath(doc, config.get("item_xpath", ITEM_XPATH), source_type)
 
     if "field_parsing_failure" not in report:
         report["field_parsing_failure"] = []
-    for item in get_xpath(doc, config.get("item_xpath", ITEM_XPATH), source_type):
-        fields = {}
-        for key, xpath in (FIELDS_XPATH | config.get("xpath", {})).items():
-            if xpath is None:
-                # Can be deliberately set to `None` to skip default fields.
-                continue
-            if len(field := get_xpath(item, xpath, source_type)) != 1:
-                report["field_parsing_failure"].append((
-                    config['name'],
-                    key,
-                    len(field),
-                ))
-                logger.warning(f"An item from feed {config['name']} (url `{config['url']}`) has {len(field)} (!= 1) `{key}` fields.")
-                fields[key] = None
+
+    def on_failure(key, num):
+        report["field_parsing_failure"].append((
+            config['name'],
+            key,
+            num,
+        ))
+        logger.warning(f"An item from feed {config['name']} (url `{config['url']}`) has {num} (!= 1) `{key}` fields.")
+
+    # The fields are extracted when they are looked up, see `common.item`.
+    fields_xpath = dict(get_fields_xpath(config))
+    scls = source_type_class_map[source_type]
+    try:
+        for idx, node in enumerate(items):
+            if stream and idx == 0:
+                # Elements before the first item are not freed yet.
+                check_ttl(get_ttl(doc.root, source_type), config)
+            if extracted:
+                fields, failures = node
+                for key, num in failures:
+                    on_failure(key, num)
+                yield Item(None, scls, {}, config.get("fields", {}), fields=fields)
             else:
-                fields[key] = field[0]
-        yield fields
+                # Must be materialized before the next item is asked for, when the node of a streamed item is freed.
+                yield Item(node, scls, fields_xpath, config.get("fields", {}), on_failure)
+    finally:
+        if stream:
+            # Stop downloading if the items are not all consumed.
+            metrics.add(report, "feeds", config["name"], bytes=doc.response.raw.tell())
+            doc.close()
+    if stream and doc.error is not None:
+        logger.error(f"Failed to parse from url={config['url']}. {source_type=}. Error `{doc.error}`.")
+        report["parse_from_url_errors"].append({
+            "name": config["name"],
+        })
+
+
+@functools.lru_cache(maxsize=None)
+def get_default_sort_key(default_sort_key_field: str):
+    return eval_expression(default_sort_key_field, FUNCS)
 
 
 def get_item_sort_key(item, config):
-    default_sort_key = eval(str(config.get("default_sort_key", "0")), FUNCS)
+    default_sort_key = get_default_sort_key(str(config.get("default_sort_key", "0")))
     sort_key_field = config.get("sort_key")
     if "get_item_sort_key_errors" not in report:
         report["get_item_sort_key_errors"] = []
     try:
         if sort_key_field is not None:
-            sort_key = eval(sort_key_field, FUNCS | item) or default_sort_key
+            sort_key = eval_expression(sort_key_field, FUNCS, item) or default_sort_key
         else:
             sort_key = default_sort_key
     except Exception as e:
@@ -163,19 +398,21 @@ def get_item_sort_key(item, config):
             sort_key_field,
             default_sort_key,
         ))
-        logger.error(f"Failed to eval sort key for a feed in group {config['name']}. Error `{e}`. Use default key `{default_sort_key!r}` instead. {item=}, {sort_key_field=}")
+        if not isinstance(e, SyntaxError):
+            # Syntax errors are already reported when compiling.
+            logger.error(f"Failed to eval sort key for a feed in group {config['name']}. Error `{e}`. Use default key `{default_sort_key!r}` instead. {item=}, {sort_key_field=}")
         sort_key = default_sort_key
     return sort_key
 
 
 def get_item_id(item, id_field):
     try:
-        if not (item_id := str(eval(id_field or "link", FUNCS | item))):
+        if not (item_id := str(eval_expression(id_field or "link", FUNCS, item))):
             item_id = None
     except Exception as e:
         item_id = None
     if not item_id:
-        logger.debug(f"Failed to eval id for an item. Skipped. {item=}")
+        logger.opt(lazy=True).debug("Failed to eval id for an item. Skipped. item={}", lambda: repr(item))
     return item_id
 
 
@@ -183,130 +420,364 @@ def md5(string: str):
     return hashlib.md5(string.encode("utf-8")).hexdigest()[:8]
 
 
-def main(config):
+def get_sorted_run(feed_config, items, group_config):
+    # The new items of a feed as sent by a group, with the fields of the group, as `(sort_key, hashed_item_id, item)` sorted by the key,
+    # and the number of items without an id. Computed once for each feed and config, however many groups and chats share them.
+    run = []
+    errors = 0
+    for item in items:
+        item = GroupItem(item, feed_config, group_config)
+        if (item_id := get_item_id(item, group_config.get("id", feed_config.get("id")))) is None:
+            errors += 1
+            continue
+        run.append((get_item_sort_key(item, group_config), md5(item_id), item))
+    run.sort(key=lambda entry: entry[0])
+    return run, errors
+
+
+def merge_reports(reports, disjoint=False):
+    # Merge the reports of several runs into one, e.g. the runs of a daemon between two reports.
+    # With `disjoint`, the reports are of different feeds, e.g. of the shards of a run, so no report replaces another.
+    merged = {}
+    for run_report in reports:
+        for key, value in run_report.items():
+            if key not in merged or (key == "open_circuits" and not disjoint):
+                merged[key] = copy.deepcopy(value)
+            elif key == "next_fetch_time" and not disjoint:
+                fetched = set(item["name"] for item in merged[key] if item["fetch"])
+                merged[key] = [item | {"fetch": item["fetch"] or item["name"] in fetched} for item in value]
+            elif key == "stats":
+                metrics.merge(merged[key], value)
+            elif isinstance(value, (list, Counter)):
+                merged[key] += value
+            elif isinstance(value, dict):
+                merged[key] |= value
+    return merged
+
+
+def dump_report(report):
+    # As JSON, with the datetimes as timestamps, the Counters as dicts and the tuples as lists. See `load_report`.
+    return json.dumps(report, default=lambda value: value.timestamp())
+
+
+def load_report(data):
+    report = json.loads(data)
+    report["start_at"] = datetime.datetime.fromtimestamp(report["start_at"]).astimezone(datetime.timezone.utc)
+    for key in ["next_fetch_time", "open_circuits"]:
+        for item in report.get(key, []):
+            item["time"] = datetime.datetime.fromtimestamp(item["time"]).astimezone(datetime.timezone.utc)
+    for key in ["get_feed_item_id_errors", "get_group_item_id_errors", "send_message_errors"]:
+        if key in report:
+            report[key] = Counter(report[key])
+    for key in ["field_parsing_failure", "get_item_sort_key_errors"]:
+        if key in report:
+            report[key] = [tuple(value) for value in report[key]]
+    if "stats" in report:
+        report["stats"] = metrics.merge({}, report["stats"])
+    return report
+
+
+def collect_shard_reports(report, shard):
+    # Each shard adds its report to the list `shard_reports`. The shard which finds there the reports of all the shards
+    # takes them all, and gets them merged to send as one report. The others get None.
+    index, num_shards = shard
+    with r.pipeline() as pipe:
+        pipe.rpush("shard_reports", f"{index} {dump_report(report)}")
+        pipe.ltrim("shard_reports", -SHARD_REPORTS, -1)
+        pipe.lrange("shard_reports", 0, -1)
+        *_, entries = pipe.execute()
+    if len(set(entry.split(" ", 1)[0] for entry in entries)) < num_shards:
+        return None
+    # Taken at once, so that no two shards send the same reports.
+    with r.pipeline() as pipe:
+        pipe.lrange("shard_reports", 0, -1)
+        pipe.delete("shard_reports")
+        entries, _ = pipe.execute()
+    shard_reports = defaultdict(list)
+    for entry in entries:
+        index, data = entry.split(" ", 1)
+        shard_reports[index].append(load_report(data))
+    if not shard_reports:
+        return None
+    return merge_reports(sorted(map(merge_reports, shard_reports.values()), key=lambda report: report["start_at"]), disjoint=True)
+
+
+def send_report(report=report, chats_info=None, shard=None):
+    # With `shard`, the report is sent with the reports of the other shards, by the last of them.
+    if admin_chat_id:
+        if shard is not None and (report := collect_shard_reports(report, shard)) is None:
+            return
+        for line in get_report_string(report, chats_info):
+            ret = _send_message(bot_token, admin_chat_id, text=line)
+            logger.debug(f"Report response: {ret.text}")
+
+
+def main(config, stop=None, lookahead=None, publish_report=True, shard=None, archive=None):
+    # `stop`: an event set to finish the run early, see `daemon`.
+    # `lookahead`: fetch the feeds due in that many seconds. By default, by the middle of the next run.
+    # `shard`: `(index, num_shards)`, to fetch only the feeds of this shard. See `scheduler.get_shards`.
+    # `archive`: an `Archive` to save what the run reads from Redis into, see `common.archive`.
+    # Returns the next time a feed of the run is due.
+    report.clear()
     report["start_at"] = datetime.datetime.now().astimezone(datetime.timezone.utc)
+    started_at = time.perf_counter()
 
     if bot_token is None:
         logger.error("No bot token is given.")
         return
 
-    feeds = {}
-    for feed in config.get("feeds", []):
-        if (name := feed.get("name")) is None:
-            logger.error("No name for the feed.")
-            logger.debug(f"{feed=}")
-            continue
-        expand_from = feed.get("expand_from")
-        if expand_from is not None:
-            if not isinstance(expand_from, list):
-                logger.warning(f"`expand_from` of feed {name} is of type `{type(expand_from)}`, should be a list.")
-            else:
-                for from_feed in reversed(expand_from):
-                    if from_feed not in feeds:
-                        logger.error(f"Unknown feed {from_feed} to expand from. Asked by {feed.get('name')}.")
-                        logger.debug(f"{feed=}")
-                    else:
-                        feed = merge_dict(feeds[from_feed], feed)
-
-        feed_fields = set(["name", "url", "id", "fields", "expand_from", "interval", "source_type", "method", "request_args", "item_xpath", "xpath",])
-        if len(ukn_fields := (set(feed.keys()) - feed_fields)):
-            logger.error(f"Feed {name} have unknown fields: {', '.join(ukn_fields)}.")
-
-        feeds[name] = feed
-
-    group_feeds = defaultdict(list, {name: [(name, {})] for name, feed in feeds.items() if "url" in feed})
-    for group in config.get("rssgroups", []):
-        group_name = group.get("name")
-        if not group_name:
-            logger.error(f"The group does not have a name. {group=}")
-            continue
-        if group_name in group_feeds:
-            logger.warning(f"Repeat group `{group_name}`. Will append the previous one.")
-
-        if not group.get("feeds"):
-            logger.warning(f"No feeds in group `{group_name}`.")
-            continue
-
-        group_fields = set(["name", "feeds", "message_config", "sort_key", "default_sort_key", "id", "fields",])
-        if len(ukn_fields := (set(group.keys()) - group_fields)):
-            logger.error(f"Group {name} have unknown fields: {', '.join(ukn_fields)}.")
-
-        for group_feed in group.get("feeds", []):
-            if group_feed in group_feeds:
-                group_feeds[group_name] += [(_name, merge_dict(_config, group)) for _name, _config in group_feeds[group_feed]]
-            else:
-                logger.error(f"Unrecognised feed `{group_feed}` in group `{group_name}`. Skipped.")
+    # Resolved by `common.config`.
+    feeds = config["feeds"]
+    group_feeds = config["group_feeds"]
+    fetch_config = config.get("fetch_config", {})
 
     # Start to send...
-    feed_item_ids = r.hgetall(f"feed_item_ids")
-    new_feed_item_ids = defaultdict(list)
+    new_http_cache = {}
+    fetched_item_ids = defaultdict(list)
     feed_items = defaultdict(list)
     chats = config.get("chats", {})
-    feeds_to_send = set([name for group in chats.values() for name, config in group_feeds[group]])
-    feeds_to_fetch = filter_feeds_by_interval({
+    feeds_to_send = set([name for group in chats.values() for name, config in group_feeds.get(group, [])])
+    intervals = {
         feed_name: feed.get("interval", INTERVAL)
         for feed_name, feed in feeds.items()
         if "url" in feed
-    }) & feeds_to_send
+    }
+    # Each shard fetches and reports its own feeds, along with all the feeds sharing a group with them.
+    # The others are still in `intervals`, so as not to be dropped from the schedule.
+    shard_feeds = set(intervals) if shard is None else set(
+        feed_name for feed_name, feed_shard in scheduler.get_shards(
+            [[feed_name] for feed_name in intervals] + [[feed_name for feed_name, _ in group_feeds.get(group, [])] for group in chats.values()],
+            shard[1]
+        ).items()
+        if feed_shard == shard[0] and feed_name in intervals
+    )
+    stored = store.prefetch()
+    http_cache, schedule = stored["http_cache"], stored["schedule"]
+    # A feed which failed last time is fetched in full, so that only reading all of it (not a 304) counts as a recovery.
+    http_cache = {feed_name: value for feed_name, value in http_cache.items() if not schedule["failures"].get(feed_name)}
+    due_times = scheduler.get_due_times(schedule, {feed_name: intervals[feed_name] for feed_name in shard_feeds})
+    if lookahead is None:
+        lookahead = fetch_config.get("task_interval", TASK_INTERVAL) * 60 / 2
+    now = datetime.datetime.now().timestamp()
+    feeds_to_fetch = set(
+        feed_name for feed_name, due_time in due_times.items()
+        if due_time <= now + lookahead
+    ) & feeds_to_send
+    # The item ids are read only for the feeds due, once the schedule is known.
+    stored |= store.prefetch_item_ids(feeds_to_fetch)
+    feed_item_ids, legacy_feeds = stored["item_ids"], stored["legacy_feeds"]
+    if archive is not None:
+        archive.save_state(config, stored)
+    started_at = metrics.lap(report, "load", started_at)
 
     report["num_items"] = []
     report["get_feed_item_id_errors"] = Counter()
-    for feed_name in feeds_to_fetch:
-        feed = feeds[feed_name]
-        item_ids = feed_item_ids.get(feed_name, "")
-        logger.debug(f"Get feed items from feed {feed_name}")
-        for idx, item in enumerate(get_feed_items(feed)):
-            item_id = get_item_id(item, feeds[feed_name].get("id"))
-            if item_id is None:
-                report["get_feed_item_id_errors"][feed_name] += 1
-                continue
-            hashed_item_id = md5(item_id)
-            if hashed_item_id in item_ids:
-                report["num_items"].append({"num": len(feed_items[feed_name]), "name": feed_name, "break": 1, "item_id": item_id})
+    report["not_modified"] = []
+    report["skipped"] = []
+    # Only the feeds processed before a stop are saved as fetched, the others are fetched again by the next run.
+    fetched_feeds = set()
+    with contextlib.closing(fetch_feeds([feeds[feed_name] for feed_name in feeds_to_fetch], fetch_config, http_cache)) as results:
+        for feed, doc, feed_http_cache in results:
+            if stop is not None and stop.is_set():
+                logger.info("Stopped before all the feeds are fetched.")
                 break
-            new_feed_item_ids[feed_name].append(hashed_item_id)
-            feed_items[feed_name].append(feed.get("fields", {}) | item)
-        else:
-            report["num_items"].append({"num": len(feed_items[feed_name]), "name": feed_name, "break": 0})
+            if doc is SKIPPED:
+                logger.warning(f"Feed {feed['name']} is skipped, for other feeds from the same host have failed.")
+                report["skipped"].append(feed["name"])
+                continue
+            fetched_feeds.add(feed_name := feed["name"])
+            if feed_http_cache is not None:
+                new_http_cache[feed_name] = feed_http_cache
+            if doc is NOT_MODIFIED:
+                logger.debug(f"Feed {feed_name} is not modified since the last fetch.")
+                report["not_modified"].append(feed_name)
+                continue
+            item_ids = feed_item_ids[feed_name]
+            overlap = False
+            logger.debug(f"Get feed items from feed {feed_name}")
+            extract_started_at = time.perf_counter()
+            # Process-wide: includes what the threads still fetching allocate meanwhile.
+            allocated = profiling.get_allocated()
+            with contextlib.closing(get_feed_items(feed, doc)) as items:
+                for item in items:
+                    item_id = get_item_id(item, feeds[feed_name].get("id"))
+                    if item_id is None:
+                        report["get_feed_item_id_errors"][feed_name] += 1
+                        continue
+                    hashed_item_id = md5(item_id)
+                    fetched_item_ids[feed_name].append(hashed_item_id)
+                    if hashed_item_id in item_ids:
+                        overlap = True
+                        if feed.get("stream"):
+                            # Streamed feeds are expected to put new items first, so stop downloading at the first item sent before.
+                            break
+                        # Sent before. The feed may have reordered or re-published it, so keep looking for new items.
+                        continue
+                    if overlap and feed_name in legacy_feeds:
+                        # Items after the first one sent before were sent before too, but their ids were not stored. Store them, without sending.
+                        continue
+                    feed_items[feed_name].append(item.materialize())
+            metrics.add(report, "feeds", feed_name, extract_seconds=time.perf_counter() - extract_started_at, items=len(fetched_item_ids.get(feed_name, [])))
+            if allocated is not None:
+                metrics.add(report, "feeds", feed_name, extract_process_alloc_bytes=profiling.get_allocated()[1] - allocated[0])
+            report["num_items"].append({"num": len(feed_items[feed_name]), "name": feed_name, "overlap": overlap})
+    started_at = metrics.lap(report, "fetch", started_at)
 
     report["get_group_item_id_errors"] = Counter()
-    send_message_args = defaultdict(list)
+    send_message_args = {}
+    runs = {}
+    group_messages = {}
     for chat_id, group_name in chats.items():
-        item_ids = set()
-        for item in sorted([
-            {"feed_config": feeds[feed_name], "group_config": group_feed_config} | group_feed_config.get("fields", {}) | item
-            for feed_name, group_feed_config in group_feeds[group_name]
-            for item in feed_items.get(feed_name, [])
-        ], key=lambda item: get_item_sort_key(item, item["group_config"])):
-            item_id = get_item_id(item, item["group_config"].get("id", item["feed_config"].get("id")))
-            if item_id is None:
-                report["get_group_item_id_errors"][group_name] += 1
-                continue
-            if (hashed_item_id := md5(item_id)) not in item_ids:
-                item_ids.add(hashed_item_id)
-                send_message_args[chat_id].append((bot_token, chat_id, item, item["group_config"]))
-
-    report["num_messages"] = [{"num": len(m), "chat": chats[chat_id], "feeds": [name for name, _ in group_feeds[chats[chat_id]]], "chat_id": chat_id} for chat_id, m in send_message_args.items()]
+        # Chats of the same group get the same messages.
+        if group_name not in group_messages:
+            group_runs = []
+            for feed_name, group_feed_config in group_feeds.get(group_name, []):
+                if (key := (feed_name, id(group_feed_config))) not in runs:
+                    runs[key] = get_sorted_run(feeds[feed_name], feed_items.get(feed_name, []), group_feed_config)
+                group_runs.append(runs[key][0])
+                if errors := runs[key][1]:
+                    report["get_group_item_id_errors"][group_name] += errors
+            item_ids = set()
+            items_to_send = []
+            # Stable, like sorting all the items of the group: items with the same key are in the order of the feeds of the group.
+            for _, hashed_item_id, item in heapq.merge(*group_runs, key=lambda entry: entry[0]):
+                if hashed_item_id not in item_ids:
+                    item_ids.add(hashed_item_id)
+                    items_to_send.append((item, item["group_config"]))
+            group_messages[group_name] = list(render_messages(items_to_send))
+        if group_messages[group_name]:
+            send_message_args[chat_id] = group_messages[group_name]
+
+    started_at = metrics.lap(report, "group", started_at)
+
+    report["num_messages"] = [{"num": len(m), "chat": chats[chat_id], "feeds": [name for name, _ in group_feeds.get(chats[chat_id], [])], "chat_id": chat_id} for chat_id, m in send_message_args.items()]
     logger.debug(f"Messages to send: {report['num_messages']}")
-    for idx in range(max_idx := max([len(m) for chat_id, m in send_message_args.items()], default=0)):
-        logger.debug(f"Send messages ... ({idx} / {max_idx})")
-        for chat_id, _messages in send_message_args.items():
-            if idx < len(_messages):
-                send_message(*_messages[idx], report=report)
-
-    update_last_fetch_time(feeds_to_fetch)
-    if new_feed_item_ids:
-        r.hset(f"feed_item_ids", mapping={
-            key: ":".join(ids)
-            for key, ids in new_feed_item_ids.items()
-            if ids
-        })
 
-    if admin_chat_id:
-        for line in get_report_string():
-            ret = _send_message(bot_token, admin_chat_id, text=line)
-            logger.debug(f"Report response: {ret.text}")
+    # Everything is saved in one transaction, so that a killed run either loses nothing or has all its messages queued.
+    with r.pipeline() as pipe:
+        for chat_id, messages in send_message_args.items():
+            outbox.enqueue(pipe, chat_id, messages)
+        update_last_fetch_time(fetched_feeds, pipe)
+        if ttl := {feed_name: ttl for feed_name, ttl in report.get("ttl", {}).items() if ttl is not None}:
+            pipe.hset("feed_ttl", mapping=ttl)
+        if no_ttl := [feed_name for feed_name, ttl in report.get("ttl", {}).items() if ttl is None and feed_name in schedule["ttl"]]:
+            pipe.hdel("feed_ttl", *no_ttl)
+        schedule["ttl"] = {feed_name: ttl for feed_name, ttl in (schedule["ttl"] | report.get("ttl", {})).items() if ttl is not None}
+        circuit_breaker = CIRCUIT_BREAKER | fetch_config.get("circuit_breaker", {})
+        # Including streamed feeds which failed after their validators were taken, e.g. truncated.
+        failed = set(item["name"] for item in report.get("parse_from_url_errors", []))
+        next_fetch_time = scheduler.update_schedule(
+            pipe, schedule,
+            # Skipped feeds are not fetched, but put back on their grids.
+            {feed_name: len(feed_items[feed_name]) > 0 for feed_name in fetched_feeds | set(report["skipped"])},
+            intervals, now, fetch_config.get("max_backoff", MAX_BACKOFF),
+            failed,
+            circuit_breaker, set(report["skipped"])
+        )
+        if fetched_item_ids:
+            update_item_ids(fetched_item_ids, feeds, pipe)
+        if new_http_cache := {key: value for key, value in new_http_cache.items() if key not in failed}:
+            pipe.hset("http_cache", mapping={
+                key: json.dumps(value)
+                for key, value in new_http_cache.items()
+            })
+        if failed:
+            pipe.hdel("http_cache", *failed)
+        pipe.execute()
+    started_at = metrics.lap(report, "save", started_at)
+
+    report["next_fetch_time"] = [
+        {
+            "name": feed_name,
+            "fetch": feed_name in fetched_feeds,
+            "time": datetime.datetime.fromtimestamp(next_fetch_time.get(feed_name, due_time)).astimezone(datetime.timezone.utc),
+        }
+        for feed_name, due_time in due_times.items()
+    ]
+    report["open_circuits"] = [
+        {
+            "name": feed_name,
+            "failures": failures,
+            "time": datetime.datetime.fromtimestamp(next_fetch_time.get(feed_name, due_times[feed_name])).astimezone(datetime.timezone.utc),
+        }
+        for feed_name, failures in scheduler.get_open_circuits(schedule, circuit_breaker).items()
+        if feed_name in due_times
+    ]
+
+    if (send_config := config.get("send_config", {})).get("send_after_fetch", True):
+        outbox.drain(
+            lambda chat_id, message: deliver_message(bot_token, chat_id, message, report=report),
+            send_config.get("max_workers", MAX_SEND_WORKERS),
+            stop=stop
+        )
+        metrics.lap(report, "send", started_at)
+    metrics.save_summary(report)
+
+    if publish_report:
+        send_report(chats_info=stored["chats"], shard=shard)
+    return min((next_fetch_time.get(feed_name, due_times[feed_name]) for feed_name in feeds_to_send & due_times.keys()), default=None)
+
+
+def daemon(poll_interval, report_interval, shard=None):
+    # Keep running, fetching each feed when it is due instead of on the ticks of an external scheduler.
+    # On SIGTERM or SIGINT, the current run stops fetching, saves what it has fetched, finishes the messages being sent and sends the report.
+    if bot_token is None:
+        logger.error("No bot token is given.")
+        return
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stop.set())
+    config = CONFIG
+    reports = []
+    reported_at = datetime.datetime.now().timestamp()
+    next_due = 0
+    while not stop.is_set():
+        try:
+            if r.get("config_version") != config.get("version"):
+                config = get_config(r)
+                logger.info(f"Reloaded config {config.get('version')}.")
+                next_due = 0
+            # Woken up only to check the config.
+            if next_due <= datetime.datetime.now().timestamp():
+                if (next_due := main(config, stop=stop, lookahead=0, publish_report=False, shard=shard)) is None:
+                    next_due = datetime.datetime.now().timestamp() + poll_interval
+                reports.append(copy.deepcopy(report))
+            now = datetime.datetime.now().timestamp()
+            if reports and (stop.is_set() or now - reported_at >= report_interval * 60):
+                send_report(merge_reports(reports), shard=shard)
+                reports, reported_at = [], now
+        except Exception:
+            # E.g. Redis or Telegram is down for a moment. What the run did not save is done again by the next one.
+            logger.exception("The run failed. Try again later.")
+            next_due = datetime.datetime.now().timestamp() + poll_interval
+        stop.wait(min(max(next_due - datetime.datetime.now().timestamp(), 1), poll_interval))
+
+
+def parse_shard(value):
+    index, num_shards = map(int, value.split("/"))
+    if not 1 <= index <= num_shards:
+        raise argparse.ArgumentTypeError(f"{value}: expected I/N with 1 <= I <= N.")
+    return index, num_shards
 
 
 if __name__ == "__main__":
-    main(CONFIG)
+    parser = argparse.ArgumentParser(description="Fetch the feeds and queue the new items as messages.")
+    parser.add_argument("--daemon", action="store_true", help="Keep running, fetching the feeds when they are due.")
+    parser.add_argument("--poll-interval", type=float, default=60, metavar="SECONDS", help="With --daemon, check for config changes at least every SECONDS seconds.")
+    parser.add_argument("--report-interval", type=float, default=60, metavar="MINUTES", help="With --daemon, send the report every MINUTES minutes.")
+    parser.add_argument("--shard", type=parse_shard, metavar="I/N", help="Run as the I-th of N workers, each fetching its own share of the feeds. The report is sent by the last one to finish.")
+    parser.add_argument("--record", metavar="DIR", help="Save the responses of the feeds and what the run reads from Redis into DIR, to run it again with `scripts/replay.py DIR`.")
+    parser.add_argument("--profile", metavar="DIR", help="Profile the run, and save the stats into DIR. See `common/profiling.py`.")
+    args = parser.parse_args()
+    if args.daemon:
+        if args.record or args.profile:
+            parser.error("--record and --profile are for a single run, without --daemon.")
+        daemon(args.poll_interval, args.report_interval, args.shard)
+    else:
+        archive = None
+        if args.record:
+            (archive := Archive(args.record)).record(feed_session)
+        with profiling.profile(args.profile) if args.profile else contextlib.nullcontext():
+            main(CONFIG, shard=args.shard, archive=archive)
+        if archive is not None:
+            archive.save()
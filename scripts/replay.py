@@ -0,0 +1,65 @@
+# coding: utf-8
+
+# Runs `scripts/fetch.py` again on what a run saved with `--record DIR`, without the network: the feeds are answered
+# from the archive, the messages are accepted by a stand-in of the Telegram Bot API at once, and the report is printed.
+# Redis is fakeredis if installed, or the scratch Redis given by `--redis-url`, which is FLUSHED. It only takes the
+# writes of the run, which reads the recorded state instead.
+#   python scripts/fetch.py --record run1
+#   python scripts/replay.py run1 --profile run1/profile
+# Feeds not recorded (e.g. due by the time of the replay but not of the run) fail as if they were down.
+
+import os
+import sys
+import argparse
+import contextlib
+import time
+from loguru import logger
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main(args):
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+    # Read by `const.py` when imported.
+    os.environ["BOT_TOKEN"] = "replay"
+    os.environ.pop("ADMIN_CHAT_ID", None)
+    if args.redis_url:
+        os.environ["REDIS_URL"] = args.redis_url
+    else:
+        import fakeredis
+        import redis
+        fake_server = fakeredis.FakeServer()
+        redis.from_url = lambda url, **kwargs: fakeredis.FakeRedis(server=fake_server, **kwargs)
+    from const import r
+    r.flushdb()
+    from common import profiling, send_message, store
+    from common.archive import Archive, ReplayAdapter, NullAdapter
+    from common.rate_limiter import RateLimiter
+    from common.session import feed_session, telegram_session
+    from scripts import fetch
+
+    archive = Archive(args.archive)
+    state = archive.load_state()
+    for prefix in ["http://", "https://"]:
+        feed_session.mount(prefix, ReplayAdapter(archive))
+        telegram_session.mount(prefix, NullAdapter())
+    send_message.rate_limiter = RateLimiter(1e9, 1e9)
+    store.prefetch = lambda: state["stored"]
+    store.prefetch_item_ids = lambda feed_names: {key: state["stored"][key] for key in ["item_ids", "legacy_feeds"]}
+
+    started_at = time.perf_counter()
+    with profiling.profile(args.profile) if args.profile else contextlib.nullcontext():
+        fetch.main(state["config"], publish_report=False)
+    print(f"Replayed in {time.perf_counter() - started_at:.2f}s.")
+    for page in fetch.get_report_string(fetch.report, state["stored"]["chats"]):
+        print(page)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run `scripts/fetch.py` again on a run saved with `--record`, without the network.")
+    parser.add_argument("archive", metavar="DIR", help="The directory given to `--record`.")
+    parser.add_argument("--profile", metavar="DIR", help="Profile the run, and save the stats into DIR. See `common/profiling.py`.")
+    parser.add_argument("--redis-url", help="A scratch Redis to use instead of fakeredis. It is flushed!")
+    parser.add_argument("--log-level", default="WARNING", help="Level of the logs of the bot, e.g. DEBUG.")
+    main(parser.parse_args())
@@ -0,0 +1,28 @@
+# coding: utf-8
+
+import argparse
+import time
+from loguru import logger
+from const import MAX_SEND_WORKERS, CONFIG, bot_token
+from common import outbox
+from common.send_message import deliver_message
+
+
+def main(config):
+    if bot_token is None:
+        logger.error("No bot token is given.")
+        return
+    outbox.drain(
+        lambda chat_id, message: deliver_message(bot_token, chat_id, message),
+        config.get("send_config", {}).get("max_workers", MAX_SEND_WORKERS)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send the messages queued by `scripts/fetch.py`.")
+    parser.add_argument("--loop", type=float, metavar="SECONDS", help="Keep sending, checking the queues every SECONDS seconds.")
+    args = parser.parse_args()
+    main(CONFIG)
+    while args.loop:
+        time.sleep(args.loop)
+        main(CONFIG)
@@ -0,0 +1,28 @@
+# coding: utf-8
+
+import itertools
+import random
+from common import scheduler
+
+
+def test_get_shards_chained_groups():
+    for groups in itertools.permutations([["c", "d"], ["b", "c"], ["a", "b"], ["e"]]):
+        shards = scheduler.get_shards(list(groups), 1000)
+        assert shards["a"] == shards["b"] == shards["c"] == shards["d"] == scheduler.get_shard("a", 1000)
+        assert shards["e"] == scheduler.get_shard("e", 1000)
+
+
+def test_get_shards_random_groups():
+    rng = random.Random(0)
+    for _ in range(100):
+        groups = [rng.sample(range(30), rng.randint(1, 3)) for _ in range(15)]
+        groups = [[f"f{name}" for name in names] for names in groups]
+        shards = scheduler.get_shards(groups, 1000)
+        # Feeds linked through any chain of groups go to the shard of the least of them.
+        components = [set(names) for names in groups]
+        while any(a & b for a, b in itertools.combinations(components, 2)):
+            a, b = next((a, b) for a, b in itertools.combinations(components, 2) if a & b)
+            components.remove(b)
+            a |= b
+        for names in components:
+            assert set(shards[name] for name in names) == {scheduler.get_shard(min(names), 1000)}